@@ -0,0 +1,213 @@
+'''
+Spatial aggregation of the aligned bottin data on polygon layers: square or hexagonal grids generated over an
+extent, or any polygons read from a file (e.g. arrondissements or quartiers, gpd.read_file(...)).
+
+The points (street centroids, or positions of geocoding.geocode_house_numbers) are assigned to the polygons with
+one bulk query on a spatial index (STRtree) and counted per cell, year and profession tag in one sparse matrix
+(rows: cell and year, columns: tags), from which heatmaps (cells x years) and tables for
+paris_methods.get_change_from_pivot (tags x years of a cell) are taken.
+
+Usage
+---------------
+cells = make_hex_grid(PARIS_EXTENT, 500)
+counts, years, tags = count_on_cells(rich_data, cells, streets=aligned_streets)
+heatmap = get_cell_year_counts(counts, len(years), tags.get_indexer(["boucher"]))
+change_year, change_years = get_change_from_pivot(get_cell_pivot(counts, years, tags, cell=3))
+'''
+import numpy as np
+import pandas as pd
+import shapely
+from scipy.sparse import coo_matrix
+from shapely.strtree import STRtree
+from paris_methods import reproject_coordinates
+from instrumentation import instrument
+
+
+def _extent_to_3857(extent, crs):
+    # corners of the extent (west, south, east, north) in epsg:3857
+    west, south, east, north = extent
+    if crs != "epsg:3857":
+        (west, east), (south, north) = reproject_coordinates([west, east], [south, north], crs_from=crs,
+                                                            crs_to="epsg:3857", always_xy=True)
+    return west, south, east, north
+
+
+@instrument
+def make_square_grid(extent, x_steps, y_steps, crs="epsg:3857"):
+    '''
+    Square grid over the extent as polygon layer, numbered like paris_methods.get_gridnumber on the grid of
+    create_grid_from_extent (row by row from the south-west, starting at 1).
+
+    Parameters
+    ---------------
+    :extent: tuple (west, south, east, north), e.g. analysis.PARIS_EXTENT
+    :x_steps: number of grid cells on the x axis
+    :y_steps: number of grid cells on the y axis
+    :crs: coordinate system of the extent, the grid is always in epsg:3857
+
+    Returns
+    ---------------
+    GeoDataFrame with one polygon per cell, indexed by the grid number ("cell")
+    '''
+    import geopandas as gpd
+
+    west, south, east, north = _extent_to_3857(extent, crs)
+    xs, ys = np.linspace(west, east, x_steps+1), np.linspace(south, north, y_steps+1)
+    x0, y0 = np.meshgrid(xs[:-1], ys[:-1])
+    x1, y1 = np.meshgrid(xs[1:], ys[1:])
+    polygons = shapely.box(x0.ravel(), y0.ravel(), x1.ravel(), y1.ravel())
+    cells = pd.Index(np.arange(1, len(polygons) + 1), name="cell")
+    return gpd.GeoDataFrame(geometry=polygons, index=cells, crs="epsg:3857")
+
+
+@instrument
+def make_hex_grid(extent, size, crs="epsg:3857"):
+    '''
+    Hexagonal grid (pointy-top hexagons) covering the extent as polygon layer.
+
+    Parameters
+    ---------------
+    :extent: tuple (west, south, east, north), e.g. analysis.PARIS_EXTENT
+    :size: distance from the center of a hexagon to its corners (in meters)
+    :crs: coordinate system of the extent, the grid is always in epsg:3857
+
+    Returns
+    ---------------
+    GeoDataFrame with one polygon per cell, indexed by the cell number ("cell", starting at 1)
+    '''
+    import geopandas as gpd
+
+    west, south, east, north = _extent_to_3857(extent, crs)
+    width = np.sqrt(3) * size
+    rows = np.arange(int(np.ceil((north - south) / (1.5 * size))) + 2)
+    columns = np.arange(int(np.ceil((east - west) / width)) + 2)
+    row, column = np.meshgrid(rows, columns, indexing="ij")
+    # every second row is shifted by half a hexagon
+    center_x = west + (column.ravel() + 0.5 * (row.ravel() % 2)) * width
+    center_y = south + row.ravel() * 1.5 * size
+    angles = np.deg2rad(30 + 60 * np.arange(7))
+    coords = np.stack([center_x[:, None] + size * np.cos(angles), center_y[:, None] + size * np.sin(angles)],
+                    axis=-1)
+    polygons = shapely.polygons(coords)
+    cells = pd.Index(np.arange(1, len(polygons) + 1), name="cell")
+    return gpd.GeoDataFrame(geometry=polygons, index=cells, crs="epsg:3857")
+
+
+@instrument
+def assign_to_cells(points, cells):
+    '''
+    Finds the polygon of cells containing every point, with one bulk query on a spatial index (STRtree) over
+    the polygons. Points on the border of several polygons get the first of them.
+
+    Parameters
+    ---------------
+    :points: array or GeoSeries of points, in the crs of cells (missing points are allowed)
+    :cells: GeoDataFrame/GeoSeries of polygons (grid of make_square_grid/make_hex_grid or any polygon layer)
+
+    Returns
+    ---------------
+    numpy array with the position of the polygon in cells for every point, -1 for points outside of all
+    polygons
+    '''
+    points = np.asarray(points, dtype=object)
+    tree = STRtree(np.asarray(cells.geometry.values, dtype=object))
+    point_positions, cell_positions = tree.query(points, predicate="intersects")
+    order = np.lexsort((cell_positions, point_positions))
+    point_positions, cell_positions = point_positions[order], cell_positions[order]
+    # (no True to start with if no point intersects a polygon)
+    first = np.ones(len(point_positions), dtype=bool)
+    first[1:] = point_positions[1:] != point_positions[:-1]
+    result = np.full(len(points), -1, dtype=np.int64)
+    result[point_positions[first]] = cell_positions[first]
+    return result
+
+
+@instrument
+def count_on_cells(entries, cells, points=None, streets=None, year_column="annee", tag_column="tags"):
+    '''
+    Counts the entries per cell, year and profession tag in one sparse matrix. The entries are placed on the
+    points (one per entry), or on the centroids of their streets (one spatial query per street, not per entry).
+
+    Parameters
+    ---------------
+    :entries: aligned data with the columns year_column, tag_column and "street_id" (if streets is given)
+    :cells: GeoDataFrame of polygons (see assign_to_cells)
+    :points: GeoSeries/array of points, one per entry (e.g. of geocoding.geocode_house_numbers)
+    :streets: street table of alignment.add_street_ids, used if points is None
+    :year_column: column with the years (or decades, e.g. "annee_bin")
+    :tag_column: column with the profession tags, entries without tag are not counted
+
+    Returns
+    ---------------
+    :counts: scipy.sparse csr_matrix of shape (number of cells * number of years, number of tags), row
+            cell position * number of years + year position, entries outside of all cells are not counted
+    :years: sorted numpy array of the years (positions of the rows within a cell)
+    :tags: pandas index of the tags (positions of the columns)
+    '''
+    if points is not None:
+        cell_positions = assign_to_cells(points, cells)
+    elif streets is not None:
+        street_ids = entries["street_id"].to_numpy()
+        used, inverse = np.unique(street_ids, return_inverse=True)
+        positions = streets.index.get_indexer(used)
+        if (positions < 0).any():
+            raise ValueError(f"street ids missing in the street table: {used[positions < 0][:10].tolist()}")
+        centroids = shapely.centroid(np.asarray(streets.geometry.values, dtype=object)[positions])
+        cell_positions = assign_to_cells(centroids, cells)[inverse]
+    else:
+        raise ValueError("points or streets are needed to place the entries")
+
+    year_codes, years = pd.factorize(entries[year_column], sort=True)
+    tag_codes, tags = pd.factorize(entries[tag_column], sort=True)
+    counted = (cell_positions >= 0) & (year_codes >= 0) & (tag_codes >= 0)
+    rows = cell_positions[counted] * len(years) + year_codes[counted]
+    counts = coo_matrix((np.ones(int(counted.sum()), dtype=np.int32), (rows, tag_codes[counted])),
+                        shape=(len(cells) * len(years), len(tags))).tocsr()
+    return counts, np.asarray(years), pd.Index(tags)
+
+
+def get_cell_year_counts(counts, n_years, tag_positions=None):
+    '''
+    Number of entries per cell and year (e.g. for a heatmap), of all tags or of the selected tags.
+
+    Parameters
+    ---------------
+    :counts: sparse matrix of count_on_cells
+    :n_years: number of years of count_on_cells
+    :tag_positions: if not None, positions of the tags which are counted (e.g. tags.get_indexer(["boucher"]))
+
+    Returns
+    ---------------
+    numpy array of shape (number of cells, number of years)
+    '''
+    if tag_positions is not None:
+        counts = counts[:, np.asarray(tag_positions)]
+    return np.asarray(counts.sum(axis=1)).reshape(-1, n_years)
+
+
+def get_cell_pivot(counts, years, tags, cell=None):
+    '''
+    Number of entries per tag and year of one cell (or of all cells), in the form of the pivot table of
+    paris_methods.get_change_over_years, so it can be passed to get_change_from_pivot.
+
+    Parameters
+    ---------------
+    :counts, years, tags: result of count_on_cells
+    :cell: if not None, position of the cell in cells
+
+    Returns
+    ---------------
+    pandas dataframe with the tags as rows and the years as columns (like pd.pivot_table, only tags and years
+    with entries)
+    '''
+    n_years = len(years)
+    if cell is None:
+        # sums the rows of all cells per year
+        n_rows = counts.shape[0]
+        per_year = coo_matrix((np.ones(n_rows), (np.arange(n_rows), np.arange(n_rows) % n_years)),
+                            shape=(n_rows, n_years)).tocsr()
+        matrix = (counts.T @ per_year).toarray()
+    else:
+        matrix = counts[cell * n_years:(cell + 1) * n_years].T.toarray()
+    pivot = pd.DataFrame(matrix, index=tags, columns=years)
+    return pivot.loc[matrix.any(axis=1), matrix.any(axis=0)]
@@ -1,10 +1,38 @@
 import pandas as pd
-from fuzzywuzzy import process, fuzz
-import multiprocessing
-from multiprocessing.dummy import Pool
-from functools import partial
+import os
+import pickle
+import hashlib
+import numpy as np
+from rapidfuzz.process import cdist
+from rapidfuzz.distance import Indel
+from instrumentation import instrument, add_counters
 
 
+# substitutions of frequent OCR errors etc. in the bottin streets (found by hand)
+WORD_SUBSTITUTION = {
+    "boulevard": "boulevard de",
+    "boulevard de de ": "boulevard de ",
+    "boulevard de d'": "boulevard d'",
+    "boulevards": "boulevard des",
+    "damede": "dame de",
+    "damedes": "dame des",
+    "faubourgsaint": "faubourg saint",
+    "faubourgpoissonniere": "faubourg poissonniere",
+    "faubourgdu": "faubourg du",
+    "faubourgmontmartre": "faubourg montmartre",
+    "quai jemmapes": "quai de jemmapes",
+    "boulevards italiens": "boulevard des italiens",
+    "villeneuve": "ville neuve",
+    "quai valmy": "quai de valmy",
+    "avenue wagram": "avenue de wagram",
+    "boulevard de montparnasse": "boulevard du montparnasse",
+}
+
+# characters removed from the streets for the alignment without spaces (regular expressions)
+NO_SPACES_SUBSTITUTION = {r"\ ": "", r"\|": "", r"\.": "", r"\:": "", "'": ""}
+
+
+@instrument
 def align_on_column(df_not_aligned, df_streets, df_aligned=pd.DataFrame(), 
                     mergeOnLeft="street", mergeOnRight="street", align_method=""):
     '''
@@ -44,6 +72,7 @@ def align_on_column(df_not_aligned, df_streets, df_aligned=pd.DataFrame(),
     # update not aligned dataframe
     not_aligned = merged[merged[mergeOnRight].isna()]
     not_aligned = not_aligned.drop(list(streets.columns), axis=1)
+    add_counters(newly_aligned=len(newly_aligned), not_aligned=len(not_aligned))
 
     # print statistics
     print(f"Joining on {mergeOnLeft} and {mergeOnRight}, method:{align_method}\n" +\
@@ -52,6 +81,208 @@ def align_on_column(df_not_aligned, df_streets, df_aligned=pd.DataFrame(),
     return aligned, not_aligned
 
 
+def _match_keys(keys, df_streets, mergeOnRight):
+    # hash join of distinct keys with the column mergeOnRight of the street data, returns pairs
+    # (position in keys, position in df_streets) in the order a left join would produce them
+    right = pd.DataFrame({"key": df_streets[mergeOnRight].values, "street_pos": np.arange(len(df_streets))})
+    right = right[right["key"].notna()]
+    pairs = pd.DataFrame({"key": keys, "key_pos": np.arange(len(keys))}).merge(right, on="key", sort=False)
+    return pairs["key_pos"].values, pairs["street_pos"].values
+
+
+def _expand_matches(codes, n_keys, key_pos, street_pos):
+    # takes the key code of every row (-1: no key) and the matching pairs of _match_keys, returns 
+    # for every match the position of the row (in codes) and of the street (rows are repeated if
+    # their key matches several streets, like in a left join)
+    order = np.argsort(key_pos, kind="stable")
+    key_pos, street_pos = key_pos[order], street_pos[order]
+    counts = np.bincount(key_pos, minlength=n_keys)
+    starts = np.cumsum(counts) - counts
+    valid_codes = np.where(codes >= 0, codes, 0)
+    row_counts = np.where(codes >= 0, counts[valid_codes], 0)
+    rows = np.repeat(np.arange(len(codes)), row_counts)
+    within = np.arange(len(rows)) - np.repeat(np.cumsum(row_counts) - row_counts, row_counts)
+    streets = street_pos[starts[valid_codes[rows]] + within]
+    return rows, streets
+
+
+def _materialize_alignment(df_not_aligned, matches, remaining):
+    # builds the aligned and not aligned dataframes from the row and street positions of every stage; a key
+    # column with the same name in both dataframes is kept once (like in the merge of align_on_column)
+    aligned_parts = []
+    for align_method, df_streets, rows, streets, shared_key in matches:
+        part = df_not_aligned.iloc[rows].copy()
+        overlap = set(part.columns).intersection(df_streets.columns) - {shared_key}
+        if overlap:
+            raise ValueError(f"columns overlap between bottin and street data: {sorted(overlap)}")
+        street_part = df_streets.iloc[streets]
+        for column in street_part.columns:
+            if column != shared_key:
+                part[column] = street_part[column].values
+        part["align_method"] = align_method
+        aligned_parts.append(part)
+
+    methods = list(dict.fromkeys(align_method for align_method, _, _, _, _ in matches))
+    if aligned_parts:
+        aligned = pd.concat(aligned_parts)
+    else:
+        aligned = df_not_aligned.iloc[[]].assign(align_method="")
+    aligned["align_method"] = pd.Categorical(aligned["align_method"], categories=methods)
+    not_aligned = df_not_aligned.iloc[remaining]
+    return aligned, not_aligned
+
+
+def _vocabulary_keys(vocab_codes, vocabulary, mergeOnLeft, remaining):
+    # computes the keys of a stage on the distinct values (vocabulary) of the not aligned entries only 
+    # and broadcasts them back to the entries; returns the key code of every entry and the distinct keys
+    row_codes = vocab_codes[remaining]
+    active = np.unique(row_codes[row_codes >= 0])
+    active_vocabulary = pd.Series(vocabulary[active], index=active)
+    if callable(mergeOnLeft):
+        active_vocabulary = mergeOnLeft(active_vocabulary)
+    key_codes, keys = pd.factorize(np.asarray(active_vocabulary, dtype=object))
+    # last position stays -1 for entries without value (code -1)
+    vocab_key_codes = np.full(len(vocabulary) + 1, -1)
+    vocab_key_codes[active] = key_codes
+    return vocab_key_codes[row_codes], keys
+
+
+@instrument
+def align_cascade(df_not_aligned, stages, verbose=True, vocabulary_column=None):
+    '''
+    Aligns the data in several stages, like consecutive calls of align_on_column: every stage is a left join
+    of the entries which have not been aligned by one of the previous stages.
+    Each stage only looks up the distinct keys of the not aligned entries in the street data, the aligned 
+    and not aligned dataframes are built once at the end.
+
+    If vocabulary_column is given, this column is factorized once into integer codes and its distinct values
+    (the vocabulary, e.g. the distinct values of "rue_processed"). Stages on this column, or with a function
+    as mergeOnLeft, are then computed on the vocabulary of the not aligned entries only and mapped back 
+    to the entries with the codes. This way, substitutions, removal of spaces or fuzzy matching can be 
+    used as stages without computing them for every entry.
+
+    Parameters
+    -------------------
+    :df_not_aligned: pandas dataframe with entries that have to be aligned
+    :stages: list of tuples (mergeOnLeft, df_streets, mergeOnRight, align_method), in the order they
+            should be applied
+        mergeOnLeft: name of the column of the non-aligned data the join should be executed on, or (if
+                    vocabulary_column is given) a function which takes a pandas Series of vocabulary 
+                    entries and returns a Series of keys of the same length 
+                    (e.g. lambda rues: rues.map(fuzzy_dict85))
+        df_streets: pandas dataframe with the geolocated street data
+        mergeOnRight: name of the column of the street data the join should be executed on
+        align_method: name of the alignment method (will be saved in column "align_method")
+    :verbose: if True, print the statistics of every stage
+    :vocabulary_column: if not None, name of the column whose distinct values the stages are computed on
+
+    Returns
+    --------------------
+    :aligned: pandas dataframe with all aligned data (entries keep their index), the columns of the
+            street data and the categorical column "align_method"
+    :not_aligned: pandas dataframe with data which could not be aligned
+    :report: pandas dataframe with the statistics of every stage
+    '''
+    if vocabulary_column is not None:
+        vocab_codes, vocabulary = pd.factorize(df_not_aligned[vocabulary_column])
+        vocabulary = np.asarray(vocabulary, dtype=object)
+    remaining = np.arange(len(df_not_aligned))
+    matches, report = [], []
+    total_aligned = 0
+    for stage, (mergeOnLeft, df_streets, mergeOnRight, align_method) in enumerate(stages):
+        # distinct keys of the not aligned entries (entries without key get code -1)
+        if vocabulary_column is not None and (callable(mergeOnLeft) or mergeOnLeft == vocabulary_column):
+            codes, keys = _vocabulary_keys(vocab_codes, vocabulary, mergeOnLeft, remaining)
+        else:
+            codes, keys = pd.factorize(df_not_aligned[mergeOnLeft].values[remaining])
+        key_pos, street_pos = _match_keys(keys, df_streets, mergeOnRight)
+        rows, streets = _expand_matches(codes, len(keys), key_pos, street_pos)
+
+        shared_key = mergeOnRight if mergeOnLeft == mergeOnRight else None
+        matches.append((align_method, df_streets, remaining[rows], streets, shared_key))
+        remaining = np.delete(remaining, np.unique(rows))
+        total_aligned += len(rows)
+        left_name = getattr(mergeOnLeft, "__name__", mergeOnLeft)
+        report.append({"stage": stage, "align_method": align_method, "mergeOnLeft": left_name, 
+                    "mergeOnRight": mergeOnRight, "distinct_keys": len(keys), "newly_aligned": len(rows), 
+                    "total_aligned": total_aligned, "not_aligned": len(remaining)})
+        if verbose:
+            print(f"Joining on {left_name} and {mergeOnRight}, method:{align_method}\n" +\
+                f"#total aligned: {total_aligned}, newly aligned: {len(rows)}, not aligned: {len(remaining)}")
+
+    add_counters(newly_aligned=total_aligned, not_aligned=len(remaining))
+    aligned, not_aligned = _materialize_alignment(df_not_aligned, matches, remaining)
+    return aligned, not_aligned, pd.DataFrame(report)
+
+
+# columns of the street data kept once per street in the street table of add_street_ids
+STREET_COLUMNS = ["streetname", "geometry", "name", "year"]
+
+
+def add_street_ids(street_tables, columns=STREET_COLUMNS, id_column="street_id"):
+    '''
+    Gives every street of the street tables an integer id (consecutive over all tables, smallest integer
+    dtype possible) in the new column id_column. Aligning on these tables copies the id to the aligned entries,
+    so the aligned data only has to store the id instead of the geometry, names and years of the street:
+    these are kept once per street in the returned street table and joined with join_streets when needed.
+
+    Parameters
+    ---------------
+    :street_tables: list of (geo)pandas dataframes with street data (e.g. [streets, unique_short_s]), the
+                id column is added in place
+    :columns: columns of the street data kept in the street table (if they exist)
+    :id_column: name of the id column
+
+    Returns
+    ---------------
+    (geo)pandas dataframe with one row per street, indexed by the id
+    '''
+    total = sum(len(table) for table in street_tables)
+    dtype = np.int16 if total <= np.iinfo(np.int16).max else np.int32
+    parts, start = [], 0
+    for table in street_tables:
+        table[id_column] = np.arange(start, start + len(table), dtype=dtype)
+        start += len(table)
+        parts.append(table[[id_column] + [column for column in columns if column in table.columns]])
+    return pd.concat(parts, ignore_index=True).set_index(id_column)
+
+
+def join_streets(df, streets, columns=None, id_column="street_id"):
+    '''
+    Adds columns of the street table of add_street_ids to the entries of df, looked up by their street id.
+    Should be called as late as possible (e.g. after selecting the entries of one year and some professions),
+    so the columns are only built for the entries which need them.
+
+    Parameters
+    ---------------
+    :df: pandas dataframe with the column id_column (e.g. aligned data)
+    :streets: street table of add_street_ids (also after writing and reading it with storage.py)
+    :columns: list of columns of the street table to add, default: all
+    :id_column: name of the id column
+
+    Returns
+    ---------------
+    copy of df with the street columns, a geopandas dataframe if geometries are added
+    '''
+    columns = list(streets.columns) if columns is None else list(columns)
+    positions = streets.index.get_indexer(df[id_column])
+    if (positions < 0).any():
+        raise ValueError(f"{id_column} of some entries is not in the street table")
+    result = df.copy()
+    for column in columns:
+        result[column] = streets[column].array.take(positions)
+    # geometry columns keep their crs, "geometry" is the active geometry if it is added
+    geometries = [column for column in columns if result[column].dtype.name == "geometry"]
+    if geometries:
+        geometry = "geometry" if "geometry" in geometries else geometries[0]
+        if hasattr(result, "set_geometry"):
+            # df is already a geopandas dataframe, its active geometry is replaced
+            result = result.set_geometry(geometry)
+        elif type(streets) is not pd.DataFrame:
+            result = type(streets)(result, geometry=geometry)
+    return result
+
+
 #methods for fuzzy matching
 
 #ravis code (see Enriching rich data project)
@@ -92,6 +323,9 @@ def get_closest_street_w_cutoff(additional_args, bottin_data):
     if above the defined threshold, return tuple with bottin street and most similar matching street
     from clean streetlist
     '''
+    # fuzzywuzzy is only needed for this reference implementation (get_fuzzy_dict uses rapidfuzz)
+    from fuzzywuzzy import process, fuzz
+
     streets, score_cutoff = additional_args
     best_one = process.extractOne(bottin_data, streets, processor=simple_processor, scorer=fuzz.ratio,
                                 score_cutoff=score_cutoff)
@@ -101,10 +335,12 @@ def get_closest_street_w_cutoff(additional_args, bottin_data):
         return (bottin_data, best_one[0])
 
 
+@instrument
 def get_fuzzy_dict(streets, bottin_streets, score_cutoff):
     '''
     takes the list of bottin streets and gets the most similar street from list of streets,
     pair is saved in a dictionary if the similarity surpasses the specified threshold
+    (see get_fuzzy_dicts)
 
     Parameters
     -------------
@@ -116,23 +352,163 @@ def get_fuzzy_dict(streets, bottin_streets, score_cutoff):
     ---------------
     :fuzzy_dict: dictionary of the form {bottin street: clean street}
     '''
-    # use multiprocessing to speed up computation
-    pool = Pool(multiprocessing.cpu_count())
+    return get_fuzzy_dicts(streets, bottin_streets, [score_cutoff])[score_cutoff]
+
+
+def _length_candidates(length, street_lengths, score_cutoff):
+    # fuzz.ratio is at most 200*min(len1, len2)/(len1+len2), so streets whose length differs too much
+    # from the length of the bottin street can never reach the score cutoff (after rounding)
+    if length == 0:
+        return np.flatnonzero(street_lengths == 0)
+    max_score = 200 * np.minimum(street_lengths, length) / (street_lengths + length)
+    return np.flatnonzero(max_score >= score_cutoff - 0.5)
+
+
+@instrument
+def get_fuzzy_dicts(streets, bottin_streets, score_cutoffs, workers=-1, chunksize=500):
+    '''
+    takes the list of bottin streets and gets the most similar street from list of streets for several
+    score cutoffs in one pass; gives the same result as extractOne with fuzz.ratio (fuzzywuzzy with 
+    python-Levenshtein): the similarity is rounded to an integer and for equal similarities, the first
+    street in the list of streets is chosen.
+    The similarities are computed in batches with rapidfuzz (multithreaded C++), only against streets
+    whose length allows to reach the lowest score cutoff.
+
+    Parameters
+    -------------
+    :streets: list of streets (strings) with the clean street data
+    :bottin_streets: list of streets which have to be aligned
+    :score_cutoffs: list of threshold values for similarity (ints between 0 and 100)
+    :workers: number of threads used by rapidfuzz (-1: all cpus)
+    :chunksize: maximal number of bottin streets compared in one batch
+
+    Returns
+    ---------------
+    :fuzzy_dicts: dictionary of the form {score cutoff: {bottin street: clean street}}
+    '''
+    streets = list(streets)
+    street_lengths = np.array([len(street) for street in streets])
+    min_cutoff = min(score_cutoffs)
+
+    # group the (unique) bottin streets by length, all of them have the same candidate streets
+    by_length = {}
+    for bottin_street in dict.fromkeys(bottin_streets):
+        by_length.setdefault(len(bottin_street), []).append(bottin_street)
+
+    # best matching street and its score for every bottin street
+    best_matches = {}
+    for length, queries in by_length.items():
+        candidates = _length_candidates(length, street_lengths, min_cutoff)
+        if len(candidates) == 0:
+            continue
+        candidate_streets = [streets[i] for i in candidates]
+        length_sum = length + street_lengths[candidates]
+        for start in range(0, len(queries), chunksize):
+            chunk = queries[start:start+chunksize]
+            distances = cdist(chunk, candidate_streets, scorer=Indel.distance, processor=None,
+                            dtype=np.int32, workers=workers)
+            # same computation as fuzz.ratio: int(round(100 * ratio)), equal strings have score 100
+            with np.errstate(divide="ignore", invalid="ignore"):
+                scores = np.round(100 * ((length_sum - distances) / length_sum))
+            scores[:, length_sum == 0] = 100
+            best = scores.argmax(axis=1)
+            best_scores = scores[np.arange(len(chunk)), best]
+            for bottin_street, index, score in zip(chunk, best, best_scores):
+                if score >= min_cutoff:
+                    best_matches[bottin_street] = (candidate_streets[index], score)
+
+    fuzzy_dicts = {}
+    for score_cutoff in score_cutoffs:
+        fuzzy_dicts[score_cutoff] = {bottin_street: street for bottin_street, (street, score) 
+                                    in best_matches.items() if score >= score_cutoff}
+    return fuzzy_dicts
+
+
+# name of the similarity measure used by get_fuzzy_dicts, part of the cache key
+FUZZY_SCORER = "fuzz.ratio"
+
+
+def get_fuzzy_cache_path(streets, score_cutoff, cache_dir="data/fuzzy_cache"):
+    '''
+    returns the path of the cache file for fuzzy dictionaries, which is named by a hash of the
+    street vocabulary (independent of its order), the scorer and the score cutoff
+
+    Parameters
+    -------------
+    :streets: list of streets (strings) with the clean street data
+    :score_cutoff: threshold value for similarity (int between 0 and 100)
+    :cache_dir: folder the cache files are stored in
 
-    # compute the pairs of similar streets -> results of form [(bottin street, clean street)]
-    results = pool.map(partial(get_closest_street_w_cutoff, (streets, score_cutoff)), bottin_streets)
+    Returns
+    ---------------
+    path (string) of the cache file
+    '''
+    content = "\n".join([FUZZY_SCORER, str(score_cutoff)] + sorted(set(streets)))
+    key = hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_dir, f"fuzzy_dict_{score_cutoff}_{key}.pkl")
 
-    pool.close()
-    pool.join()
 
-    # remove None values from the results
-    results_set = set(results)
-    results_set.remove(None)
+@instrument
+def get_cached_fuzzy_dicts(streets, bottin_streets, score_cutoffs, cache_dir="data/fuzzy_cache"):
+    '''
+    same as get_fuzzy_dicts, but the results are cached on disk: for every score cutoff, the cache stores 
+    all bottin streets which have already been compared to the street vocabulary and the resulting pairs. 
+    Only bottin streets which are not in the cache yet are compared and appended to it, so adding new 
+    bottin data (e.g. another year) does not recompute the existing pairs. A different street vocabulary, 
+    scorer or cutoff uses a different cache file.
+    The cache file is chosen by the set of streets (not their order), the matching uses the order of the
+    street list like get_fuzzy_dicts (for equal similarities, the first street in the list is chosen), so
+    the result is the same as without cache. Bottin streets taken from the cache keep the street chosen
+    when they were compared, which can differ on equal similarities if the same streets are given in
+    another order.
+
+    Parameters
+    -------------
+    :streets: list of streets (strings) with the clean street data
+    :bottin_streets: list of streets which have to be aligned
+    :score_cutoffs: list of threshold values for similarity (ints between 0 and 100)
+    :cache_dir: folder the cache files are stored in
+
+    Returns
+    ---------------
+    :fuzzy_dicts: dictionary of the form {score cutoff: {bottin street: clean street}}, only containing
+                the bottin streets in bottin_streets
+    '''
+    streets = list(dict.fromkeys(streets))
+    bottin_streets = list(dict.fromkeys(bottin_streets))
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # load caches of the form {"scored": set of bottin streets, "matches": {bottin street: clean street}}
+    caches, paths = {}, {}
+    for score_cutoff in score_cutoffs:
+        paths[score_cutoff] = get_fuzzy_cache_path(streets, score_cutoff, cache_dir)
+        try:
+            with open(paths[score_cutoff], "rb") as f:
+                caches[score_cutoff] = pickle.load(f)
+        except FileNotFoundError:
+            caches[score_cutoff] = {"scored": set(), "matches": {}}
 
-    # convert to dictionary
-    fuzzy_dict = dict(results_set)
+    # compute the pairs for all bottin streets which are missing in at least one cache
+    unseen = [street for street in bottin_streets 
+              if any(street not in cache["scored"] for cache in caches.values())]
+    add_counters(cache_hits=len(bottin_streets) - len(unseen), cache_misses=len(unseen))
+    if unseen:
+        new_dicts = get_fuzzy_dicts(streets, unseen, score_cutoffs)
+        for score_cutoff, cache in caches.items():
+            cache["scored"].update(unseen)
+            cache["matches"].update(new_dicts[score_cutoff])
+            # write to temporary file first to not leave a broken cache behind
+            with open(paths[score_cutoff] + ".tmp", "wb") as f:
+                pickle.dump(cache, f)
+            os.replace(paths[score_cutoff] + ".tmp", paths[score_cutoff])
+        print(f"fuzzy matching: {len(unseen)} new bottin streets compared, " +\
+            f"{len(bottin_streets) - len(unseen)} taken from cache")
 
-    return fuzzy_dict
+    fuzzy_dicts = {}
+    for score_cutoff, cache in caches.items():
+        matches = cache["matches"]
+        fuzzy_dicts[score_cutoff] = {street: matches[street] for street in bottin_streets if street in matches}
+    return fuzzy_dicts
 
 
 def print_sample(df, align_methods, sample_size, random_state=42):
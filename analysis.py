@@ -1,9 +1,17 @@
 import pandas as pd
+import numpy as np
+import os
 import re
-from collections import Counter
-from matplotlib import pyplot as plt
-import contextily as cx
-from PIL import Image
+from multiprocessing import Pool
+from alignment import join_streets
+from instrumentation import instrument, add_counters
+
+
+# extent of the maps with comparable=True (EPSG:3857): west, south, east, north
+PARIS_EXTENT = (250000, 6244000, 270000, 6258000)
+
+# one profession in a "tags" entry of the form "['profession1', 'profession2']"
+TAG_PATTERN = "'([a-zA-ZÀ-ÿ]+)'"
 
 
 def get_prof_list(entry):
@@ -19,7 +27,7 @@ def get_prof_list(entry):
     list of strings, containing one string per tag -> ["profession1", "profession2"]
     '''
     entry = str(entry)
-    return re.findall("'([a-zA-ZÀ-ÿ]+)'", entry)
+    return re.findall(TAG_PATTERN, entry)
 
 
 def get_prof_str(entry):
@@ -39,7 +47,132 @@ def get_prof_str(entry):
     return ", ".join(get_prof_list(entry))
 
 
-def plot_ratio_over_time(df, top_names, col_name="tags", title=""):
+def _parse_unique_tags(tags):
+    # codes of the entries of the series tags (-1: missing) and the lists of professions of its distinct
+    # values (parsed like get_prof_list, once per distinct value)
+    codes, uniques = pd.factorize(tags)
+    tag_lists = pd.Series(np.asarray(uniques, dtype=object)).astype(str).str.findall(TAG_PATTERN)
+    return codes, tag_lists
+
+
+@instrument
+def parse_tags(tags):
+    '''
+    Same as tags.apply(get_prof_str), but the regular expression is only applied once per distinct value of tags
+    (vectorized string operations), e.g. "['profession1', 'profession2']" -> "profession1, profession2".
+
+    Parameters
+    ---------------
+    :tags: pandas series with profession tags entries (strings or categorical)
+
+    Returns
+    ---------------
+    pandas series (same index) with strings of the form "profession1, profession2"
+    '''
+    codes, tag_lists = _parse_unique_tags(tags)
+    # missing entries give "" (like get_prof_str("nan"))
+    joined = np.append(tag_lists.str.join(", ").to_numpy(dtype=object), "")
+    return pd.Series(joined[codes], index=tags.index, name=tags.name)
+
+
+@instrument
+def get_tag_index(tags):
+    '''
+    Parses the profession tags entries once per distinct value and explodes them to one row per entry and
+    profession, e.g. for filtering or counting single professions by joins instead of comparing the joined
+    strings of parse_tags/get_prof_str.
+
+    Parameters
+    ---------------
+    :tags: pandas series with profession tags entries of the form "['profession1', 'profession2']"
+
+    Returns
+    ---------------
+    pandas dataframe with the columns "entry" (position of the entry in tags) and "tag" (categorical),
+    entries without professions have no row
+    '''
+    codes, tag_lists = _parse_unique_tags(tags)
+    lengths = np.append(tag_lists.str.len().to_numpy(dtype=np.int64), 0)
+    tag_codes, professions = pd.factorize(pd.Series([tag for tag_list in tag_lists for tag in tag_list], 
+                                                    dtype=object))
+    # position of the first profession of every distinct value in tag_codes
+    starts = np.cumsum(lengths) - lengths
+    counts = lengths[codes]
+    entries = np.repeat(np.arange(len(codes)), counts)
+    within = np.arange(len(entries)) - np.repeat(np.cumsum(counts) - counts, counts)
+    flat = starts[codes][entries] + within
+    return pd.DataFrame({"entry": entries,
+                        "tag": pd.Categorical.from_codes(tag_codes[flat], categories=professions)})
+
+
+@instrument
+def select_by_tags(df, tag_index, professions):
+    '''
+    Returns the entries of df with at least one of the professions among their tags.
+
+    Parameters
+    ---------------
+    :df: dataframe the tag index was computed on (get_tag_index(df["tags"]))
+    :tag_index: tag index of get_tag_index
+    :professions: list of profession strings, e.g. ["boucher", "boulanger"]
+    '''
+    entries = tag_index["entry"].to_numpy()[tag_index["tag"].isin(professions).to_numpy()]
+    return df.iloc[np.unique(entries)]
+
+
+@instrument
+def tags_not_before_after_specific_year(df, tag_index, year):
+    '''
+    Like jobs_not_before_after_specific_year, but for single professions (an entry "boucher, charcutier"
+    counts for "boucher" and for "charcutier"): checks which professions only occur before (or in) the given
+    year and which only occur after it.
+
+    Parameters
+    ---------------
+    :df: dataframe with the column "annee" the tag index was computed on
+    :tag_index: tag index of get_tag_index
+    :year: year the data is split on, or list of years
+
+    Returns
+    ---------------
+    :not_after_yearX: set of the professions which do not occur after year
+    :not_before_yearX: set of the professions which do not occur before or in year
+    (for a list of years: dictionary year -> (not_after_yearX, not_before_yearX))
+    '''
+    annee = pd.Series(df["annee"].to_numpy()[tag_index["entry"].to_numpy()])
+    first_last = annee.groupby(tag_index["tag"], observed=True).agg(["min", "max"])
+    return split_jobs_on_years(first_last, year)
+
+
+@instrument
+def get_ratio_over_time(df, top_names, col_name="tags"):
+    '''
+    Computes the ratio top_names/all for each year in the dataframe and each name in top_names,
+    with one groupby over the rows of the names in top_names (instead of filtering the dataframe for
+    every year and name).
+
+    Parameters
+    ----------------
+    :df: dataframe with relevant data
+    :top_names: list of the jobs/streets whose frequency should be computed over the years
+    :col_name: name of the column the strings in top_names are contained in
+
+    Returns
+    ----------------
+    dataframe with the years as index and top_names as columns, containing the ratio of entries
+    with the name in the year
+    '''
+    #number of entries per year
+    len_year = df.groupby("annee").size().sort_index()
+    #number of entries per year and name, only for the names in top_names
+    selected = df[df[col_name].isin(top_names)]
+    counts = selected.groupby(["annee", col_name], observed=True).size().unstack(fill_value=0)
+    counts = counts.reindex(index=len_year.index, columns=list(top_names), fill_value=0)
+    return counts.div(len_year, axis=0)
+
+
+@instrument
+def plot_ratio_over_time(df, top_names, col_name="tags", title="", ratio_table=None):
     '''
     Computes the ratio top_names/all for each year in the dataframe and each name in top_names
     and plots them.
@@ -50,62 +183,119 @@ def plot_ratio_over_time(df, top_names, col_name="tags", title=""):
     :top_names: list of the jobs/streets whose frequency should be plotted over the years
     :col_name: name of the column the strings in top_names are contained in
     :title: title of the plot
+    :ratio_table: if not None, table computed with get_ratio_over_time (e.g. for many names at once)
+                which the names in top_names are taken from, df is not used then
 
     Returns
     ----------------
     plot of the frequency of the jobs/streets in top_names over the years
     '''
-    #get list of all years in dataframe
-    all_years = sorted(df["annee"].unique())
-    #instantiate empty dataframe
-    df_top_jobs = pd.DataFrame(columns=top_names, index=all_years)
-    
-    #get the job/street ratio for every year seperately
-    for year in all_years:
-        year_data = df[df["annee"]==year]
-        len_year = len(year_data)
-        # get ratio for all jobs
-        for top_job in top_names:
-            job_ratio = len(year_data[year_data[col_name]==top_job])/len_year
-            df_top_jobs.loc[year, top_job] = job_ratio   
+    if ratio_table is None:
+        df_top_jobs = get_ratio_over_time(df, top_names, col_name)
+    else:
+        df_top_jobs = ratio_table[list(top_names)]
 
     #plot the data
     ax = df_top_jobs.plot.line(figsize=(10,6), title=title, colormap="hsv")
     ax.legend(bbox_to_anchor=(1.0, 1.0))
     return ax.plot()  
 
+def top_per_group(counts, n, group_levels):
+    '''
+    The n largest counts of every group, like Counter(...).most_common(n) per group (equal counts keep the
+    order of counts).
+
+    Parameters
+    ---------------
+    :counts: pandas series of counts with a multi index, e.g. from a groupby(...).size()
+    :n: number of counts per group
+    :group_levels: list of the index levels the groups are formed on
+
+    Returns
+    ---------------
+    pandas series with the selected counts
+    '''
+    return counts.sort_values(ascending=False, kind="stable").groupby(level=group_levels, observed=True).head(n)
+
+
+@instrument
 def get_jobs_overtime(df, streetname, int_top_per_decade=10):
-    selected = df[df["streetname"]==streetname]
-    selected_decades = sorted(selected["annee_bin"].unique())
-
-    selected_jobs = []
-    for decade in selected_decades:
-        selected_dec_data = selected[selected["annee_bin"]==decade]
-        top_dec_jobs = Counter(selected_dec_data["tags"]).most_common(int_top_per_decade)
-        top_dec_jobs = [name for name, count in top_dec_jobs]
-        selected_jobs += top_dec_jobs
+    '''
+    Collects the int_top_per_decade most frequent jobs of every decade in a street, from one count per
+    (street, decade, job).
+
+    Parameters
+    ---------------
+    :df: dataframe with the columns "streetname", "annee_bin" and "tags"
+    :streetname: name of the street, or list of street names (all streets are handled in one pass)
+    :int_top_per_decade: number of jobs per decade
+
+    Returns
+    ---------------
+    list of the jobs, or for a list of street names a dictionary street name -> list of the jobs
+    '''
+    streetnames = [streetname] if isinstance(streetname, str) else list(streetname)
+    selected = df.loc[df["streetname"].isin(streetnames), ["streetname", "annee_bin", "tags"]]
+    selected = selected.assign(position=np.arange(len(selected)))
+    counts = selected.groupby(["streetname", "annee_bin", "tags"], observed=True, dropna=False)["position"]\
+                    .agg(["size", "min"])
+    # equal counts in the order of the first entry of the job, like Counter.most_common
+    counts = counts.sort_values("min")["size"]
+    top = top_per_group(counts, int_top_per_decade, ["streetname", "annee_bin"]).reset_index()
     # delete duplicates
-    return list(set(selected_jobs))
+    jobs = {name: list(set(group["tags"])) for name, group in top.groupby("streetname", observed=True)}
+    if isinstance(streetname, str):
+        return jobs.get(streetname, [])
+    return {name: jobs.get(name, []) for name in streetnames}
 
-def jobs_not_before_after_specific_year(df_in, year, job_col="tags"):
+
+def split_jobs_on_years(first_last, year):
     '''
-    Splits dataset in before and after given year, then checks for jobs which are only in one of the
-    two sets.
+    Jobs which only occur before (or in) and jobs which only occur after the given year(s), from the first and
+    last year of every job.
+
+    Parameters
+    ---------------
+    :first_last: pandas dataframe indexed by job with the columns "min" and "max" (first and last year)
+    :year: year, or list of years
+
+    Returns
+    ---------------
+    tuple (not_after_yearX, not_before_yearX) of sets of jobs, or for a list of years a dictionary
+    year -> tuple
     '''
-    df = df_in.groupby(["annee", job_col]).count().reset_index()
-    df["afterYearX"] = df.apply(lambda x: x.annee>year, axis=1)
-    grouped_df = df.groupby(["afterYearX", job_col]).count().reset_index()    
-    
-    after = grouped_df[grouped_df["afterYearX"]]
-    before = grouped_df[~grouped_df["afterYearX"]]
+    if np.ndim(year) == 0:
+        return (set(first_last.index[(first_last["max"] <= year).to_numpy()]),
+                set(first_last.index[(first_last["min"] > year).to_numpy()]))
+    years = np.asarray(year)
+    # one comparison of all jobs with all years
+    not_after = first_last["max"].to_numpy()[:, None] <= years[None, :]
+    not_before = first_last["min"].to_numpy()[:, None] > years[None, :]
+    jobs = first_last.index
+    return {y: (set(jobs[not_after[:, i]]), set(jobs[not_before[:, i]])) for i, y in enumerate(year)}
 
-    jobs_after = set(after[job_col])
-    jobs_before = set(before[job_col])
 
-    not_before_yearX = jobs_after.difference(jobs_before)
-    not_after_yearX = jobs_before.difference(jobs_after)
+@instrument
+def jobs_not_before_after_specific_year(df_in, year, job_col="tags"):
+    '''
+    Splits dataset in before and after given year, then checks for jobs which are only in one of the
+    two sets. The first and last year of every job are computed in one aggregation, so many years can be
+    checked at once.
 
-    return not_after_yearX, not_before_yearX
+    Parameters
+    ---------------
+    :df_in: dataframe with the columns "annee" and job_col
+    :year: year the data is split on, or list of years
+    :job_col: column with the jobs
+
+    Returns
+    ---------------
+    :not_after_yearX: set of the jobs which do not occur after year
+    :not_before_yearX: set of the jobs which do not occur before or in year
+    (for a list of years: dictionary year -> (not_after_yearX, not_before_yearX))
+    '''
+    first_last = df_in.groupby(job_col, observed=True)["annee"].agg(["min", "max"])
+    return split_jobs_on_years(first_last, year)
 
 def sort_by_number_of_words(set_data):
     '''
@@ -127,8 +317,9 @@ def sort_by_number_of_words(set_data):
     
     return one_word, two_words, more_words
 
+@instrument
 def plot_profession_selection_on_map(df, professions, year, prof_name="name", geo_col="geometry", 
-                                    save_fig=False, comparable=True, color=None):
+                                    save_fig=False, comparable=True, color=None, basemap=None, streets=None):
     '''
     plot the distributions of professions on a map for a given year
 
@@ -142,13 +333,22 @@ def plot_profession_selection_on_map(df, professions, year, prof_name="name", ge
     :save_fig: if True, save the plot; if False, display it
     :comparable: if True, give predefined limits for x and y axis
     :color: specify color if all data should be plotted in the same color
+    :basemap: source of the basemap, e.g. path to a local raster (see get_basemap), default: CartoDB Positron
+    :streets: if not None, street table of alignment.add_street_ids: df only has the street ids and geo_col
+            is joined from the street table for the selected datapoints
     '''
-    #change column for geodata if necessary
-    if not geo_col=="geometry":
-        df = df.rename(columns={"geometry":"polygons", geo_col:"geometry"})
+    # plotting libraries are only imported when a map is drawn
+    from matplotlib import pyplot as plt
+    import contextily as cx
 
     df_year = df[df["annee"]==year]
     df_year_prof = df_year[df_year["tags"].isin(professions)]
+    if streets is not None:
+        df_year_prof = join_streets(df_year_prof, streets, [geo_col])
+
+    #change column for geodata if necessary
+    if not geo_col=="geometry":
+        df_year_prof = df_year_prof.rename(columns={"geometry":"polygons", geo_col:"geometry"}).set_geometry("geometry")
 
     #begin plotting
     fig, ax = plt.subplots(1,1,figsize=(10, 8))
@@ -160,9 +360,9 @@ def plot_profession_selection_on_map(df, professions, year, prof_name="name", ge
     else:
         _ = df_year_prof.plot(column="tags", legend=True, ax=ax, alpha=0.5, cmap="Spectral")
     if comparable:
-        plt.xlim(250000, 270000)
-        plt.ylim(6244000, 6258000)
-    _ = cx.add_basemap(ax, source=cx.providers.CartoDB.Positron)
+        plt.xlim(PARIS_EXTENT[0], PARIS_EXTENT[2])
+        plt.ylim(PARIS_EXTENT[1], PARIS_EXTENT[3])
+    _ = cx.add_basemap(ax, source=basemap or cx.providers.CartoDB.Positron)
     _ = ax.set_title(title)
 
     # save or display figure
@@ -173,6 +373,7 @@ def plot_profession_selection_on_map(df, professions, year, prof_name="name", ge
     plt.close()
 
 
+@instrument
 def make_gif(years, prof_name="name"):
     '''
     makes gif out of already saved images in subfolder "figures"
@@ -182,6 +383,8 @@ def make_gif(years, prof_name="name"):
     :years: list of years which should be used
     :prof_name: part of the name of the path the data is stored at (-> {prof_name}{year}.jpg)
     '''
+    from PIL import Image
+
     # open each image, store them in a list and convert to a gif
     frames = [Image.open(f"figures/{prof_name}{year}.jpg") for year in years]
     frame_one = frames[0]
@@ -189,24 +392,119 @@ def make_gif(years, prof_name="name"):
                save_all=True, duration=600, loop=0)
 
 
-def gif_for_professions(rich_data, professions, prof_name, geo_col="geometry", color=None):
+@instrument
+def get_basemap(path="figures/basemap.tif", source=None, extent=PARIS_EXTENT):
+    '''
+    returns the path of a local raster with the basemap of the given extent; the tiles are only downloaded
+    if the file does not exist yet, afterwards the maps can be drawn offline (any other georeferenced raster
+    in EPSG:3857 can be used as stand-in)
+
+    Parameters
+    --------------
+    :path: path of the raster file (GeoTIFF)
+    :source: tile provider, default: CartoDB Positron
+    :extent: extent of the basemap in EPSG:3857 (west, south, east, north)
     '''
-    takes a dataframe and a list of professions; first saves data plot for each year in the data
-    which shows the distribution of the professions over Paris, then makes a gif out of it
-    (all stored in subfolder "figures")
+    cached = os.path.exists(path)
+    add_counters(cache_hits=int(cached), cache_misses=int(not cached))
+    if not cached:
+        import contextily as cx
+        west, south, east, north = extent
+        cx.bounds2raster(west, south, east, north, path, source=source or cx.providers.CartoDB.Positron, ll=False)
+    return path
+
+
+def render_profession_frame(df_year_prof, year, basemap, color=None, comparable=True):
+    '''
+    draws the map of plot_profession_selection_on_map for data which is already filtered on the year and
+    professions, without pyplot (can be used in several processes at once)
+
+    Parameters
+    --------------
+    :df_year_prof: geodataframe with the datapoints of one year and the selected professions
+    :year: year of the data (used for the title)
+    :basemap: source of the basemap, e.g. path to a local raster (see get_basemap)
+    :color: specify color if all data should be plotted in the same color
+    :comparable: if True, give predefined limits for x and y axis
+
+    Returns
+    --------------
+    numpy array (height x width x 3) with the rgb values of the image
+    '''
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    import contextily as cx
+
+    fig = Figure(figsize=(10, 8))
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot(1, 1, 1)
+    if color:
+        _ = df_year_prof.plot(column="tags", legend=True, ax=ax, alpha=0.5, color=color)
+    else:
+        _ = df_year_prof.plot(column="tags", legend=True, ax=ax, alpha=0.5, cmap="Spectral")
+    if comparable:
+        ax.set_xlim(PARIS_EXTENT[0], PARIS_EXTENT[2])
+        ax.set_ylim(PARIS_EXTENT[1], PARIS_EXTENT[3])
+    _ = cx.add_basemap(ax, source=basemap)
+    _ = ax.set_title(f"Professions in Year {year}")
+    canvas.draw()
+    return np.asarray(canvas.buffer_rgba())[:, :, :3].copy()
+
+
+def _render_frame(args):
+    # helper for the process pool in gif_for_professions
+    return render_profession_frame(*args)
+
+
+@instrument
+def save_gif(frames, path, duration=600):
+    '''
+    writes frames (iterable of rgb numpy arrays) to a gif, the frames are encoded as soon as they arrive
+
+    Parameters
+    --------------
+    :frames: iterable of numpy arrays (height x width x 3)
+    :path: path of the gif
+    :duration: display duration of every frame in milliseconds
+    '''
+    from PIL import Image
+
+    images = (Image.fromarray(frame) for frame in frames)
+    frame_one = next(images)
+    frame_one.save(path, format="GIF", append_images=images, save_all=True, duration=duration, loop=0)
+
+
+@instrument
+def gif_for_professions(rich_data, professions, prof_name, geo_col="geometry", color=None, 
+                        basemap=None, processes=None, figures_dir="figures", streets=None):
+    '''
+    takes a dataframe and a list of professions; renders the distribution of the professions over Paris
+    for each year in the data (in parallel) and saves them as a gif in subfolder "figures"
 
     Parameters:
     :rich_data: dataframe with datapoints
     :professions: list of profession strings that should be displayed on the map
-    :prof_name: part of the name of the path the data is stored at (-> {prof_name}{year}.jpg)
+    :prof_name: name of the gif (-> {figures_dir}/{prof_name}.gif)
     :geo_col: the column with the geodata
     :color: specify color if all data should be plotted in the same color
+    :basemap: source of the basemap, default: local raster of get_basemap (downloaded once)
+    :processes: number of processes used for rendering, default: number of cpus
+    :figures_dir: folder the gif is saved in
+    :streets: if not None, street table of alignment.add_street_ids: rich_data only has the street ids and
+            geo_col is joined from the street table for the selected datapoints
     '''
+    if basemap is None:
+        basemap = get_basemap()
+
+    # filter data on professions once and split it by year
     subset = rich_data[rich_data["tags"].isin(professions)]
-    years = sorted(subset["annee"].unique())
-    # save image with profession distribution for each year
-    for year in years:
-        plot_profession_selection_on_map(rich_data, professions=professions, year=year, 
-                geo_col=geo_col, prof_name=prof_name, save_fig=True, color=color)
-    # make gif out of saved images and save it in "figures" folder
-    make_gif(years = years, prof_name=prof_name)
\ No newline at end of file
+    if streets is not None:
+        subset = join_streets(subset, streets, [geo_col])
+    #change column for geodata if necessary
+    if not geo_col=="geometry":
+        subset = subset.rename(columns={"geometry":"polygons", geo_col:"geometry"}).set_geometry("geometry")
+    frame_args = [(df_year, year, basemap, color) for year, df_year in subset.groupby("annee", sort=True)]
+
+    # render the images in parallel and write them to the gif in the order of the years
+    with Pool(processes) as pool:
+        save_gif(pool.imap(_render_frame, frame_args), os.path.join(figures_dir, f"{prof_name}.gif"))
@@ -0,0 +1,444 @@
+'''
+Benchmark harness for the hot paths of street processing, alignment and analysis.
+
+Runs duplicate_processing, check_overlap, assign_gridnumber, get_fuzzy_dict, align_on_column, parse_tags,
+geocode_house_numbers, count_on_cells and plot_ratio_over_time on synthetic Paris-like street geometries and
+Bottin-like address tables of configurable size, records wall time, peak memory and throughput, and compares
+them with a stored baseline. Everything is generated locally, no data or network access is needed.
+import_core and import_pipeline measure the startup of a new process importing the modules (independent of
+the size), import_core fails if the core (preprocessing, alignment) loads geo or plotting libraries.
+
+Usage
+---------------
+python benchmark.py --sizes 10000 100000                       # run all benchmarks
+python benchmark.py --sizes 4400000 --only assign_gridnumber   # run selected benchmarks
+python benchmark.py --save-baseline data/benchmark_baseline.json
+python benchmark.py --baseline data/benchmark_baseline.json    # compare with a baseline
+'''
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+import warnings
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import matplotlib
+matplotlib.use("Agg")
+from matplotlib import pyplot as plt
+
+import paris_methods
+import alignment
+import analysis
+import geocoding
+import aggregation
+from instrumentation import read_proc_status, reset_peak_rss
+
+
+# extent of the synthetic streets (EPSG:3857), the same as the maps of analysis.py
+EXTENT = analysis.PARIS_EXTENT
+
+STREET_TYPES = ["rue", "boulevard", "avenue", "quai", "place", "impasse", "passage", "cour", "faubourg", "allee"]
+ARTICLES = ["de", "du", "de la", "des", "d", ""]
+NAME_TOKENS = ["saint", "honore", "martin", "denis", "antoine", "germain", "jacques", "michel", "louis",
+               "lazare", "victor", "richelieu", "rivoli", "temple", "bac", "seine", "marais", "roi",
+               "reine", "grange", "batelière", "vaugirard", "sevres", "grenelle", "montmartre", "clichy",
+               "poissonniere", "bonne", "nouvelle", "vieille", "neuve", "petits", "champs", "fosses",
+               "ecoles", "arts", "moulins", "pont", "marche", "orfevres", "bourdonnais", "lombards",
+               "ursulines", "carmes", "cordeliers", "tournelles", "filles", "calvaire", "enfants", "rouge"]
+PROFESSIONS = ["epicier", "marchand de vin", "boulanger", "cordonnier", "tailleur", "boucher", "menuisier",
+               "coiffeur", "medecin", "avocat", "notaire", "libraire", "horloger", "bijoutier", "serrurier",
+               "peintre", "architecte", "pharmacien", "charcutier", "fruitier", "modiste", "couturiere",
+               "blanchisseur", "tapissier", "ebeniste", "marchand de bois", "chapelier", "mercier"]
+YEARS = (1839, 1922)
+
+# pure-compute modules and the libraries they must not load (see import_core)
+CORE_MODULES = ["preprocessing", "alignment"]
+GEO_AND_PLOT_MODULES = ["geopandas", "pyproj", "matplotlib", "contextily", "PIL", "fuzzywuzzy"]
+
+
+def street_count(n_rows):
+    # number of street segments for a bottin table with n_rows rows (4.4M entries: 44000 segments)
+    return int(np.clip(n_rows // 100, 100, 44000))
+
+
+def make_street_names(n_names, seed=0):
+    '''
+    Generates distinct Paris-like street names ("rue saint honore", "quai des orfevres", ...).
+
+    Parameters
+    ---------------
+    :n_names: number of names
+    :seed: seed of the random generator
+
+    Returns
+    ---------------
+    list of strings
+    '''
+    rng = np.random.default_rng(seed)
+    names = dict()
+    while len(names) < n_names:
+        n_missing = n_names - len(names)
+        types = rng.choice(STREET_TYPES, n_missing)
+        articles = rng.choice(ARTICLES, n_missing)
+        first = rng.choice(NAME_TOKENS, n_missing)
+        second = rng.choice(NAME_TOKENS + [""] * 20, n_missing)
+        for parts in zip(types, articles, first, second):
+            names[" ".join(part for part in parts if part)] = None
+    return list(names)[:n_names]
+
+
+def make_streets(n_streets, duplicate_share=0.2, seed=0):
+    '''
+    Generates Paris-like street data in EPSG:3857: polylines of 2 to 6 segments inside EXTENT with a
+    name, an identifier, a list of years and a buffer of 20m. A share of the streets reuses the name of
+    another street, half of them next to it (overlapping segments of the same street, which are merged
+    by duplicate_processing) and half of them somewhere else (streets with the same name in different
+    quarters).
+
+    Parameters
+    ---------------
+    :n_streets: number of streets
+    :duplicate_share: share of streets that reuse the name of another street
+    :seed: seed of the random generator
+
+    Returns
+    ---------------
+    geopandas dataframe with the columns "name", "IDENTIFI", "year", "geometry", "buffer" and "centroid"
+    '''
+    rng = np.random.default_rng(seed)
+    n_duplicates = int(n_streets * duplicate_share)
+    n_names = n_streets - n_duplicates
+    names = make_street_names(n_names, seed)
+
+    west, south, east, north = EXTENT
+    starts = np.column_stack([rng.uniform(west, east, n_streets), rng.uniform(south, north, n_streets)])
+    # duplicates: first half continues an existing street, second half lies anywhere
+    originals = rng.integers(0, n_names, n_duplicates)
+    adjacent = np.arange(n_duplicates) < n_duplicates // 2
+    starts[n_names:][adjacent] = starts[originals[adjacent]] + rng.normal(0, 15, (adjacent.sum(), 2))
+    street_names = names + [names[i] for i in originals]
+
+    n_segments = rng.integers(2, 7, n_streets)
+    headings = rng.uniform(0, 2 * np.pi, n_streets)
+    lines = []
+    for start, segments, heading in zip(starts, n_segments, headings):
+        angles = heading + rng.normal(0, 0.2, segments)
+        steps = rng.uniform(30, 150, segments)[:, None] * np.column_stack([np.cos(angles), np.sin(angles)])
+        lines.append(np.vstack([start, start + np.cumsum(steps, axis=0)]))
+    geometry = shapely.linestrings(np.concatenate(lines), indices=np.repeat(np.arange(n_streets), n_segments + 1))
+
+    first_years = rng.integers(YEARS[0], YEARS[1] - 10, n_streets)
+    streets = gpd.GeoDataFrame({
+        "name": street_names,
+        "IDENTIFI": np.arange(n_streets).astype(str),
+        "year": [list(range(first, first + 10)) for first in first_years.tolist()],
+    }, geometry=geometry, crs="epsg:3857")
+    streets["buffer"] = streets.geometry.buffer(20)
+    streets["centroid"] = streets.geometry.centroid
+    return streets
+
+
+def add_typos(names, share, rng):
+    # introduces one deleted, replaced or swapped character into a share of the names
+    names = list(names)
+    letters = np.array(list("abcdefghijklmnopqrstuvwxyz "))
+    for i in np.flatnonzero(rng.random(len(names)) < share).tolist():
+        name = names[i]
+        position = int(rng.integers(1, len(name) - 1))
+        operation = rng.integers(3)
+        if operation == 0:
+            names[i] = name[:position] + name[position+1:]
+        elif operation == 1:
+            names[i] = name[:position] + rng.choice(letters) + name[position+1:]
+        else:
+            names[i] = name[:position-1] + name[position] + name[position-1] + name[position+1:]
+    return names
+
+
+def make_bottins(n_rows, street_names, typo_share=0.1, seed=0):
+    '''
+    Generates a Bottin-like address table: entries with a street (Zipf-distributed over street_names,
+    a share of them misspelled), a house number, a year and a profession.
+
+    Parameters
+    ---------------
+    :n_rows: number of entries
+    :street_names: list of street names (e.g. make_streets(...)["name"])
+    :typo_share: share of distinct spellings per street which are misspelled
+    :seed: seed of the random generator
+
+    Returns
+    ---------------
+    pandas dataframe with the columns "rue_processed", "numero", "annee" and "tags"
+    '''
+    rng = np.random.default_rng(seed)
+    unique_names = list(dict.fromkeys(street_names))
+    # 3 spellings per street, the first one correct, the other ones misspelled with probability typo_share
+    spellings = np.array(unique_names + add_typos(unique_names, typo_share, rng)
+                        + add_typos(unique_names, typo_share, rng), dtype=object)
+    weights = 1 / np.arange(1, len(unique_names) + 1)
+    streets = rng.choice(len(unique_names), n_rows, p=weights / weights.sum())
+    spelling = rng.choice(3, n_rows, p=[0.9, 0.05, 0.05])
+
+    profession_weights = 1 / np.arange(1, len(PROFESSIONS) + 1)
+    return pd.DataFrame({
+        "rue_processed": spellings[spelling * len(unique_names) + streets],
+        "numero": rng.integers(1, 200, n_rows),
+        "annee": rng.integers(YEARS[0], YEARS[1] + 1, n_rows),
+        "tags": np.array(PROFESSIONS, dtype=object)[rng.choice(len(PROFESSIONS), n_rows,
+                                                            p=profession_weights / profession_weights.sum())],
+    })
+
+
+def measure(function, *args, **kwargs):
+    '''
+    Runs function(*args, **kwargs) and measures its wall time and peak memory. The peak memory is the
+    increase of the peak resident set size of the process (Linux), or the peak of the memory traced by
+    tracemalloc on other systems (which slows down the function).
+
+    Returns
+    ---------------
+    :result: return value of the function
+    :wall_time: wall time in seconds
+    :peak_memory: additional peak memory in bytes
+    '''
+    use_rss = reset_peak_rss() and read_proc_status("VmHWM") is not None
+    if use_rss:
+        rss_before = read_proc_status("VmRSS")
+    else:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    wall_time = time.perf_counter() - start
+    if use_rss:
+        peak_memory = max(read_proc_status("VmHWM") - rss_before, 0)
+    else:
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, wall_time, peak_memory
+
+
+# benchmark functions: take the size (number of bottin rows) and a seed, prepare the data and return
+# (function, args, number of processed items)
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    # registers a benchmark function in BENCHMARKS
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+def import_in_new_process(modules, forbidden=()):
+    # imports the modules in a new python process (nothing is cached), raises a RuntimeError if one of the
+    # forbidden modules is loaded by them
+    code = f"import sys; import {', '.join(modules)}; " \
+           f"print(' '.join(module for module in {list(forbidden)!r} if module in sys.modules))"
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    loaded = result.stdout.strip()
+    if loaded:
+        raise RuntimeError(f"importing {', '.join(modules)} loads {loaded}")
+
+
+@benchmark("import_core")
+def bench_import_core(size, seed):
+    return import_in_new_process, (CORE_MODULES, GEO_AND_PLOT_MODULES), len(CORE_MODULES)
+
+
+@benchmark("import_pipeline")
+def bench_import_pipeline(size, seed):
+    return import_in_new_process, (["pipeline"],), 1
+
+
+@benchmark("duplicate_processing")
+def bench_duplicate_processing(size, seed):
+    streets = make_streets(street_count(size), seed=seed)
+    return paris_methods.duplicate_processing, (streets, "name"), len(streets)
+
+
+@benchmark("check_overlap")
+def bench_check_overlap(size, seed):
+    buffers = list(make_streets(street_count(size), seed=seed)["buffer"])
+    return paris_methods.check_overlap, (buffers,), len(buffers)
+
+
+@benchmark("assign_gridnumber")
+def bench_assign_gridnumber(size, seed):
+    streets = make_streets(street_count(size), seed=seed)
+    bottins = make_bottins(size, streets["name"], seed=seed)
+    bottins = bottins.merge(streets[["name", "centroid"]].drop_duplicates("name"),
+                            left_on="rue_processed", right_on="name")
+    gridX, gridY = paris_methods.create_grid_from_extent(16, 16, EXTENT)
+    return paris_methods.assign_gridnumber, (bottins, gridX, gridY), len(bottins)
+
+
+@benchmark("get_fuzzy_dict")
+def bench_get_fuzzy_dict(size, seed):
+    streets = make_streets(street_count(size), seed=seed)
+    names = list(dict.fromkeys(streets["name"]))
+    bottins = make_bottins(size, names, typo_share=0.5, seed=seed)
+    queries = list(set(bottins["rue_processed"]) - set(names))
+    return alignment.get_fuzzy_dict, (names, queries, 85), len(queries)
+
+
+@benchmark("align_on_column")
+def bench_align_on_column(size, seed):
+    streets = make_streets(street_count(size), seed=seed)
+    streets = pd.DataFrame(streets[["name", "IDENTIFI"]].drop_duplicates("name"))
+    bottins = make_bottins(size, streets["name"], seed=seed)
+
+    def align():
+        with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            return alignment.align_on_column(bottins, streets, mergeOnLeft="rue_processed",
+                                            mergeOnRight="name", align_method="benchmark")
+    return align, (), len(bottins)
+
+
+@benchmark("parse_tags")
+def bench_parse_tags(size, seed):
+    bottins = make_bottins(size, make_street_names(street_count(size), seed), seed=seed)
+    # tags like in the tagged bottin data: "['profession']"
+    tags = "['" + bottins["tags"] + "']"
+    return analysis.parse_tags, (tags,), len(tags)
+
+
+@benchmark("geocode_house_numbers")
+def bench_geocode_house_numbers(size, seed):
+    streets = make_streets(street_count(size), seed=seed)
+    streets = alignment.add_street_ids([streets[["name", "geometry"]].copy()], columns=["name", "geometry"])
+    bottins = make_bottins(size, streets["name"], seed=seed)
+    # aligned like exact matches: the first street with the name (misspelled names: the first street)
+    first_ids = pd.Series(streets.index, index=streets["name"]).groupby(level=0).first()
+    bottins["street_id"] = first_ids.reindex(bottins["rue_processed"]).fillna(streets.index[0])\
+        .to_numpy(dtype=streets.index.dtype)
+    return geocoding.geocode_house_numbers, (bottins, streets), len(bottins)
+
+
+@benchmark("count_on_cells")
+def bench_count_on_cells(size, seed):
+    streets = make_streets(street_count(size), seed=seed)
+    bottins = make_bottins(size, streets["name"], seed=seed)
+    bottins = bottins.merge(streets[["name", "centroid"]].drop_duplicates("name"),
+                            left_on="rue_processed", right_on="name")
+    cells = aggregation.make_hex_grid(EXTENT, 500)
+    return aggregation.count_on_cells, (bottins, cells, bottins["centroid"].values), len(bottins)
+
+
+@benchmark("plot_ratio_over_time")
+def bench_plot_ratio_over_time(size, seed):
+    bottins = make_bottins(size, make_street_names(street_count(size), seed), seed=seed)
+    top_names = bottins["tags"].value_counts().index[:10].tolist()
+
+    def plot():
+        result = analysis.plot_ratio_over_time(bottins, top_names, title="benchmark")
+        plt.close("all")
+        return result
+    return plot, (), len(bottins)
+
+
+def run_benchmark(name, size, repeat=1, seed=0):
+    '''
+    Runs one benchmark, the data generation is not measured.
+
+    Parameters
+    ---------------
+    :name: name of the benchmark (key of BENCHMARKS)
+    :size: number of rows of the synthetic bottin table
+    :repeat: number of runs, the fastest wall time and the highest peak memory are kept
+    :seed: seed of the random generators
+
+    Returns
+    ---------------
+    dictionary with the name, size, number of processed items, wall time (s), peak memory (MB) and
+    throughput (items/s)
+    '''
+    function, args, n_items = BENCHMARKS[name](size, seed)
+    wall_times, peak_memories = [], []
+    for _ in range(repeat):
+        _, wall_time, peak_memory = measure(function, *args)
+        wall_times.append(wall_time)
+        peak_memories.append(peak_memory)
+    wall_time = min(wall_times)
+    return {"name": name, "size": size, "items": n_items, "wall_time": wall_time,
+            "peak_memory_mb": max(peak_memories) / 2**20,
+            "throughput": n_items / wall_time if wall_time > 0 else float("inf")}
+
+
+def compare_to_baseline(results, baseline, tolerance=0.2):
+    '''
+    Compares benchmark results with a baseline (results of an earlier run with the same sizes).
+
+    Parameters
+    ---------------
+    :results: list of dictionaries returned by run_benchmark
+    :baseline: list of dictionaries returned by run_benchmark
+    :tolerance: relative increase of the wall time which is still accepted
+
+    Returns
+    ---------------
+    pandas dataframe with one row per benchmark and size, the wall time and peak memory of the run and
+    the baseline, their ratios and the column "regression" (True if the run is slower than the baseline
+    by more than tolerance)
+    '''
+    columns = ["name", "size", "wall_time", "peak_memory_mb"]
+    comparison = pd.DataFrame(results)[columns].merge(pd.DataFrame(baseline)[columns], on=["name", "size"],
+                                                       how="left", suffixes=("", "_baseline"))
+    comparison["time_ratio"] = comparison["wall_time"] / comparison["wall_time_baseline"]
+    comparison["memory_ratio"] = comparison["peak_memory_mb"] / comparison["peak_memory_mb_baseline"]
+    comparison["regression"] = comparison["time_ratio"] > 1 + tolerance
+    return comparison
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks the hot paths on synthetic data")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000],
+                        help="numbers of rows of the synthetic bottin table (up to 4400000)")
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), default=list(BENCHMARKS),
+                        help="benchmarks to run")
+    parser.add_argument("--repeat", type=int, default=3, help="number of runs per benchmark")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--baseline", help="json file with baseline results to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="accepted relative slowdown compared to the baseline")
+    parser.add_argument("--save-baseline", help="json file the results are saved to")
+    args = parser.parse_args(argv)
+
+    results = []
+    for size in args.sizes:
+        for name in args.only:
+            result = run_benchmark(name, size, repeat=args.repeat, seed=args.seed)
+            results.append(result)
+            print(f"{name:<22} size: {size:>9}  items: {result['items']:>9}  "
+                  f"time: {result['wall_time']:9.3f}s  peak memory: {result['peak_memory_mb']:9.1f}MB  "
+                  f"throughput: {result['throughput']:12.0f}/s", flush=True)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as file:
+            json.dump({"machine": platform.platform(), "cpus": os.cpu_count(), "results": results}, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)["results"]
+        comparison = compare_to_baseline(results, baseline, args.tolerance)
+        print(comparison.to_string(index=False, float_format="{:.3f}".format))
+        if comparison["regression"].any():
+            print("Regressions (slower than the baseline by more than "
+                  f"{args.tolerance:.0%}): {', '.join(comparison.loc[comparison['regression'], 'name'])}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,295 @@
+'''
+Aggregate cube of the aligned bottin data for the analysis: number of entries per year ("annee", with its
+decade "annee_bin"), street id (see alignment.add_street_ids), grid cell and profession tag.
+
+The cube is built once from the aligned data (one row per combination which occurs, instead of one row per
+entry) and written with storage.write_dataset. The query functions answer the questions of Analysis.ipynb
+from the cube, without scanning the aligned data again.
+
+Usage
+---------------
+cube = build_cube(rich_data, aligned_streets, gridsize=4)
+write_dataset(cube, "data/analysis_cube.parquet")
+cube = read_dataset("data/analysis_cube.parquet")
+cube_ratio_over_time(cube, ["boucher", "rentier"])
+gif_for_professions(expand_cube(cube, tags=professions), professions, "food", streets=aligned_streets)
+'''
+import numpy as np
+import pandas as pd
+from shapely import get_x, get_y
+from alignment import join_streets
+from analysis import top_per_group, split_jobs_on_years
+from paris_methods import create_grid, get_gridnumber, get_change_from_pivot, get_distribution_changes
+from instrumentation import instrument
+
+
+# decades of the analysis: e.g. 1860-1869 -> 1860 (entries before 1840 -> 1839)
+YEAR_BINS = [1830, 1840, 1850, 1860, 1870, 1880, 1890, 1900, 1910, 1920, 1930]
+YEAR_BIN_LABELS = [1839, 1840, 1850, 1860, 1870, 1880, 1890, 1900, 1910, 1920]
+
+# dimensions of the cube
+CUBE_COLUMNS = ["annee", "annee_bin", "street_id", "grid", "tags"]
+
+
+def get_annee_bin(annee):
+    # decade (see YEAR_BINS) of every year of the series annee, as categorical series
+    return pd.cut(annee, right=False, bins=YEAR_BINS, labels=YEAR_BIN_LABELS)
+
+
+def get_street_grid(streets, gridsize=4, grid=None):
+    '''
+    Assigns every street of the street table to a cell of a grid over the centroids of the streets. The default
+    grid is the one of create_grid on the aligned entries (their centroids are the centroids of these streets).
+
+    Parameters
+    ---------------
+    :streets: street table of alignment.add_street_ids (only the streets of the aligned entries)
+    :gridsize: number of grid cells on each axis
+    :grid: if not None, tuple (gridX, gridY) of create_grid/create_grid_from_extent which is used instead
+
+    Returns
+    ---------------
+    pandas series with the grid number of every street (index: street id), -1 outside of the grid
+    '''
+    import geopandas as gpd
+
+    centroids = gpd.GeoDataFrame({"centroid": streets.geometry.centroid}, geometry="centroid")
+    gridX, gridY = grid if grid is not None else create_grid(gridsize, gridsize, centroids)
+    _, _, cells = get_gridnumber(get_x(centroids["centroid"].values), get_y(centroids["centroid"].values),
+                                gridX, gridY)
+    return pd.Series(cells, index=streets.index, name="grid")
+
+
+@instrument
+def build_cube(rich_data, streets, gridsize=4, grid=None, tag_column="tags"):
+    '''
+    Counts the aligned entries per year, street, grid cell and profession tag, in one groupby. Entries without
+    tag are counted as well (tag NaN), so the totals per year/street are the numbers of entries.
+
+    Parameters
+    ---------------
+    :rich_data: aligned data with the columns "annee", "street_id" and tag_column (e.g. "profession1, profession2")
+    :streets: street table of alignment.add_street_ids, used for the grid cells of the streets
+    :gridsize: number of grid cells on each axis (see get_street_grid)
+    :grid: if not None, tuple (gridX, gridY) which is used instead of the default grid
+    :tag_column: column with the profession tags
+
+    Returns
+    ---------------
+    pandas dataframe with the columns of CUBE_COLUMNS (tags as categorical) and "count"
+    '''
+    street_ids = np.unique(rich_data["street_id"])
+    street_grid = get_street_grid(streets.loc[street_ids], gridsize, grid)
+    cube = (rich_data.groupby(["annee", "street_id", tag_column], observed=True, dropna=False, sort=True)
+            .size().rename("count").reset_index().rename(columns={tag_column: "tags"}))
+    # (the groupby makes the integer keys int64)
+    cube = cube.astype({"annee": rich_data["annee"].dtype, "street_id": rich_data["street_id"].dtype,
+                        "tags": "category"})
+    # nullable integer instead of categorical, so it is the same after writing and reading the cube
+    cube["annee_bin"] = get_annee_bin(cube["annee"]).astype(float).astype("Int16")
+    cube["grid"] = street_grid.reindex(cube["street_id"]).to_numpy()
+    cube["count"] = cube["count"].astype(np.int32)
+    return cube[CUBE_COLUMNS + ["count"]]
+
+
+def _select(cube, columns, streets, selection):
+    # cells of the cube selected by selection (column=value or column=list of values), with the columns of the
+    # street table which are used in columns or selection (e.g. "streetname")
+    missing = [column for column in list(columns) + list(selection) if column not in cube.columns]
+    if missing:
+        if streets is None:
+            raise ValueError(f"the street table is needed for {missing}")
+        cube = join_streets(cube, streets, list(dict.fromkeys(missing)))
+    mask = np.ones(len(cube), dtype=bool)
+    for column, values in selection.items():
+        if isinstance(values, (list, tuple, set, np.ndarray, pd.Index)):
+            mask &= cube[column].isin(list(values)).to_numpy(dtype=bool, na_value=False)
+        else:
+            mask &= (cube[column] == values).to_numpy(dtype=bool, na_value=False)
+    return cube[mask]
+
+
+@instrument
+def query_cube(cube, by, streets=None, **selection):
+    '''
+    Sums the counts of the cube per combination of the columns in by, for the selected cells only.
+
+    Parameters
+    ---------------
+    :cube: cube of build_cube
+    :by: list of columns of the cube or of the street table (e.g. ["annee", "streetname"])
+    :streets: street table of alignment.add_street_ids, needed if by or selection use street columns
+    :selection: column=value or column=list of values, e.g. tags=["boucher", "rentier"], grid=3
+
+    Returns
+    ---------------
+    pandas series with the number of entries, indexed by the columns in by (only combinations which occur)
+    '''
+    selected = _select(cube, by, streets, selection)
+    return selected.groupby(list(by), observed=True, dropna=False)["count"].sum()
+
+
+@instrument
+def expand_cube(cube, streets=None, **selection):
+    '''
+    Repeats the selected cells of the cube by their count (one row per entry), so functions working on the
+    aligned entries (e.g. plot_profession_selection_on_map or gif_for_professions with streets=...) can be
+    used on the cube.
+
+    Parameters
+    ---------------
+    :cube: cube of build_cube
+    :streets: street table, needed if selection uses street columns
+    :selection: column=value or column=list of values (see query_cube)
+
+    Returns
+    ---------------
+    pandas dataframe with the columns of the cube (without "count"), one row per entry
+    '''
+    selected = _select(cube, [], streets, selection)
+    return selected.loc[selected.index.repeat(selected["count"]), CUBE_COLUMNS].reset_index(drop=True)
+
+
+@instrument
+def cube_ratio_over_time(cube, top_names, col_name="tags", streets=None):
+    '''
+    Same as analysis.get_ratio_over_time, computed on the cube: ratio of the entries with the names in top_names
+    per year (the result can be plotted with plot_ratio_over_time(None, top_names, ratio_table=...)).
+
+    Parameters
+    ---------------
+    :cube: cube of build_cube
+    :top_names: list of the jobs/streets whose frequency should be computed over the years
+    :col_name: "tags" or a column of the street table (e.g. "streetname")
+    :streets: street table, needed if col_name is a street column
+    '''
+    len_year = query_cube(cube, ["annee"]).sort_index()
+    counts = query_cube(cube, ["annee", col_name], streets, **{col_name: list(top_names)}).unstack(fill_value=0)
+    counts = counts.reindex(index=len_year.index, columns=list(top_names), fill_value=0)
+    return counts.div(len_year, axis=0)
+
+
+@instrument
+def cube_top_names(cube, col_name="tags", n=None, min_count=0, streets=None, **selection):
+    '''
+    Most frequent tags/streets in the (selected) cube, like df[col_name].value_counts().
+
+    Parameters
+    ---------------
+    :cube: cube of build_cube
+    :col_name: "tags" or a column of the street table (e.g. "streetname")
+    :n: if not None, only the n most frequent names
+    :min_count: only names with more entries
+    :streets: street table, needed if col_name or selection use street columns
+    :selection: column=value or column=list of values (see query_cube)
+
+    Returns
+    ---------------
+    pandas series with the number of entries per name, in descending order
+    '''
+    counts = query_cube(cube, [col_name], streets, **selection)
+    counts = counts[counts.index.notna() & (counts > min_count)].sort_values(ascending=False, kind="stable")
+    return counts if n is None else counts.iloc[:n]
+
+
+@instrument
+def cube_jobs_overtime(cube, streetname, streets, int_top_per_decade=10):
+    '''
+    Same as analysis.get_jobs_overtime on the cube: the int_top_per_decade most frequent jobs of every decade
+    in the street(s) with the name streetname (jobs with the same count may be chosen in another order).
+
+    Parameters
+    ---------------
+    :cube: cube of build_cube
+    :streetname: name of the street, or list of street names (all streets are handled in one pass)
+    :streets: street table of alignment.add_street_ids
+    :int_top_per_decade: number of jobs per decade
+
+    Returns
+    ---------------
+    list of the jobs, or for a list of street names a dictionary street name -> list of the jobs
+    '''
+    streetnames = [streetname] if isinstance(streetname, str) else list(streetname)
+    counts = query_cube(cube, ["streetname", "annee_bin", "tags"], streets, streetname=streetnames)
+    top = top_per_group(counts, int_top_per_decade, ["streetname", "annee_bin"]).reset_index()
+    jobs = {name: list(set(group["tags"])) for name, group in top.groupby("streetname", observed=True)}
+    if isinstance(streetname, str):
+        return jobs.get(streetname, [])
+    return {name: jobs.get(name, []) for name in streetnames}
+
+
+@instrument
+def cube_jobs_not_before_after_specific_year(cube, year, **selection):
+    '''
+    Same as analysis.jobs_not_before_after_specific_year on the cube: the jobs which only occur before or in the
+    given year, and the jobs which only occur after it.
+
+    Parameters
+    ---------------
+    :cube: cube of build_cube
+    :year: year the data is split on, or list of years
+    :selection: column=value or column=list of values (see query_cube), e.g. tags=frequent_jobs
+
+    Returns
+    ---------------
+    :not_after_yearX: set of the jobs which do not occur after year
+    :not_before_yearX: set of the jobs which do not occur before or in year
+    (for a list of years: dictionary year -> (not_after_yearX, not_before_yearX))
+    '''
+    counts = query_cube(cube, ["annee", "tags"], **selection).reset_index()
+    counts = counts[counts["tags"].notna()]
+    first_last = counts.groupby("tags", observed=True)["annee"].agg(["min", "max"])
+    first_last.index = first_last.index.astype(object)
+    return split_jobs_on_years(first_last, year)
+
+
+@instrument
+def cube_change_over_years(cube, yearcolumn="annee_bin", grid=None):
+    '''
+    Same as paris_methods.get_change_over_years on the cube, for all of Paris or one grid cell.
+
+    Parameters
+    ---------------
+    :cube: cube of build_cube
+    :yearcolumn: "annee" or "annee_bin"
+    :grid: if not None, number of the grid cell
+
+    Returns
+    ---------------
+    :change_year: list of the change indicators
+    :years: years of the change indicators
+    '''
+    selection = {} if grid is None else {"grid": grid}
+    counts = query_cube(cube, ["tags", yearcolumn], **selection)
+    counts = counts[counts.index.get_level_values("tags").notna()]
+    pivot = counts.unstack(fill_value=0)
+    if yearcolumn == "annee_bin":
+        # like the categorical annee_bin of the aligned data, decades without entries are kept
+        pivot = pivot.reindex(columns=YEAR_BIN_LABELS, fill_value=0)
+    # sorted like pd.pivot_table on the tags as strings
+    pivot.index = pivot.index.astype(object)
+    return get_change_from_pivot(pivot.sort_index())
+
+
+@instrument
+def cube_change_matrix(cube, location="grid", yearcolumn="annee_bin", streets=None, **kwargs):
+    '''
+    paris_methods.get_distribution_changes on the cube: change of the professional mix between consecutive year
+    bins for every location at once.
+
+    Parameters
+    ---------------
+    :cube: cube of build_cube
+    :location: "grid", "street_id" or a column of the street table (e.g. "streetname")
+    :yearcolumn: "annee" (e.g. with bin_width=5) or "annee_bin"
+    :streets: street table, needed if location is a street column
+    :kwargs: bin_width, start, window, distance, exclude_tags (see get_distribution_changes)
+
+    Returns
+    ---------------
+    pandas dataframe with the locations as rows and the first bin after every transition as columns
+    '''
+    counts = query_cube(cube, [location, "tags", yearcolumn], streets).reset_index()
+    changes, location_values, transition_years = get_distribution_changes(
+        counts[location], counts["tags"], counts[yearcolumn], counts=counts["count"], **kwargs)
+    return pd.DataFrame(changes, index=pd.Index(location_values, name=location), columns=transition_years)
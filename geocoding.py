@@ -0,0 +1,130 @@
+'''
+House-number geocoding of the aligned bottin data: instead of the geometry (or centroid) of the whole street,
+every entry gets a point on its street, interpolated from its house number ("numero").
+
+The numbers of a street are assumed to increase along its geometry (in the order its coordinates are stored).
+Odd and even numbers have their own number ranges per street, learned from the aligned data (smallest and
+largest number of the street side), and can be placed on the two sides of the street with side_offset
+(as in Paris: odd numbers on the left, even numbers on the right).
+
+Usage
+---------------
+aligned_streets = read_dataset("data/aligned_streets_tagged.parquet")
+rich_data["centroid"] = geocode_house_numbers(rich_data, aligned_streets, side_offset=5)
+assign_gridnumber(rich_data, gridX, gridY)
+'''
+import numpy as np
+import pandas as pd
+import shapely
+from shapely import get_x, get_y
+from instrumentation import instrument
+
+
+# fraction of the street length used to compute the direction of the street at a point (for side_offset)
+DIRECTION_STEP = 1e-3
+
+
+@instrument
+def parse_house_numbers(numero):
+    '''
+    Converts house numbers to floats, once per distinct value: integers stay as they are, strings like "12 bis"
+    or "12-14" give their first number.
+
+    Parameters
+    ---------------
+    :numero: pandas series of house numbers (integers or strings)
+
+    Returns
+    ---------------
+    numpy array of floats, NaN for entries without number
+    '''
+    codes, uniques = pd.factorize(numero)
+    numbers = pd.to_numeric(pd.Series(np.asarray(uniques, dtype=object)).astype(str).str.extract(r"(\d+)")[0],
+                            errors="coerce").to_numpy(dtype=float)
+    return np.append(numbers, np.nan)[codes]
+
+
+@instrument
+def learn_number_ranges(numbers, street_ids):
+    '''
+    Number range of every street side: smallest and largest odd and even number per street.
+
+    Parameters
+    ---------------
+    :numbers: array of house numbers (see parse_house_numbers)
+    :street_ids: array of the street ids of the entries, same length as numbers
+
+    Returns
+    ---------------
+    pandas dataframe indexed by street id and side (1: odd, 0: even) with the columns "min" and "max"
+    '''
+    ranges = pd.DataFrame({"street_id": street_ids, "side": np.mod(numbers, 2), "numero": numbers}).dropna()
+    return ranges.groupby(["street_id", "side"])["numero"].agg(["min", "max"])
+
+
+def _offset_points(lines, fractions, points, offsets):
+    # moves the points perpendicular to the direction of the line at their position, to the left for positive
+    # offsets (direction from the points slightly before to slightly after them)
+    before = shapely.line_interpolate_point(lines, np.clip(fractions - DIRECTION_STEP, 0, 1), normalized=True)
+    after = shapely.line_interpolate_point(lines, np.clip(fractions + DIRECTION_STEP, 0, 1), normalized=True)
+    dx, dy = get_x(after) - get_x(before), get_y(after) - get_y(before)
+    length = np.hypot(dx, dy)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        scale = np.where(length > 0, offsets / length, 0)
+    return shapely.points(get_x(points) - dy * scale, get_y(points) + dx * scale)
+
+
+@instrument
+def geocode_house_numbers(entries, streets, ranges=None, side_offset=0, number_column="numero",
+                            id_column="street_id"):
+    '''
+    Interpolates the position of every entry along the geometry of its street from its house number, for all
+    entries in one vectorized call (shapely.line_interpolate_point). The fraction of the street length is
+    (number - smallest number) / (largest number - smallest number) of the street side, entries whose street
+    side has only one number are placed in the middle of the street.
+
+    Parameters
+    ---------------
+    :entries: aligned data with the columns number_column and id_column
+    :streets: street table of alignment.add_street_ids (indexed by street id, LineStrings/MultiLineStrings)
+    :ranges: if not None, number ranges of learn_number_ranges (e.g. learned on all years), else they are
+            learned from entries
+    :side_offset: distance (in units of the street crs) of the points from the street, odd numbers to the left
+                and even numbers to the right of the street direction (0: on the street)
+    :number_column: column with the house numbers
+    :id_column: column with the street ids
+
+    Returns
+    ---------------
+    GeoSeries of points (index of entries, crs of streets), None for entries without house number or
+    number range, e.g. to be used as "centroid" in assign_gridnumber or as geo_col in the map functions
+    '''
+    import geopandas as gpd
+
+    numbers = parse_house_numbers(entries[number_column])
+    street_ids = entries[id_column].to_numpy()
+    street_positions = streets.index.get_indexer(street_ids)
+    if (street_positions < 0).any():
+        raise ValueError("street ids missing in the street table: "
+                        f"{sorted(set(street_ids[street_positions < 0]))[:10]}")
+    if ranges is None:
+        ranges = learn_number_ranges(numbers, street_ids)
+
+    side = np.mod(numbers, 2)
+    range_positions = ranges.index.get_indexer(pd.MultiIndex.from_arrays([street_ids, side]))
+    found = (range_positions >= 0) & ~np.isnan(numbers)
+    low = np.where(found, ranges["min"].to_numpy(dtype=float)[range_positions], np.nan)
+    high = np.where(found, ranges["max"].to_numpy(dtype=float)[range_positions], np.nan)
+    span = high - low
+    with np.errstate(invalid="ignore", divide="ignore"):
+        fractions = np.clip(np.where(span > 0, (numbers - low) / span, 0.5), 0, 1)
+
+    # merge the parts of the streets once per street, not once per entry
+    used, inverse = np.unique(street_positions, return_inverse=True)
+    lines = shapely.line_merge(np.asarray(streets.geometry.values, dtype=object)[used])[inverse]
+    points = np.full(len(entries), None, dtype=object)
+    points[found] = shapely.line_interpolate_point(lines[found], fractions[found], normalized=True)
+    if side_offset:
+        offsets = np.where(side[found] == 1, side_offset, -side_offset)
+        points[found] = _offset_points(lines[found], fractions[found], points[found], offsets)
+    return gpd.GeoSeries(points, index=entries.index, crs=streets.crs)
@@ -0,0 +1,328 @@
+'''
+Lightweight instrumentation of the public functions of preprocessing.py, paris_methods.py, alignment.py,
+analysis.py and storage.py.
+
+The instrumentation is off by default (instrumented functions only check a flag). Once enabled with configure,
+every call of an instrumented function (decorator instrument) or block (context manager track) is recorded
+with its wall time, input/output row counts, the peak resident set size of the process and additional
+counters (e.g. cache hits and misses) in an in-memory registry, and optionally in a JSON lines log file.
+With profile=True, a sampling profiler records which functions the time was spent in.
+With reset_peak=True, the peak resident set size of the process is reset before every top-level call, so
+the peak of each call is measured (this also resets it for other code measuring the peak memory).
+
+Usage
+---------------
+import instrumentation
+instrumentation.configure(enabled=True, log_path="data/instrumentation.jsonl", profile=True)
+... run the notebook cells ...
+instrumentation.summary()                      # one row per function
+instrumentation.get_records()                  # one row per call
+
+with instrumentation.track("street processing", rows_in=len(df)):
+    ...
+'''
+import functools
+import json
+import sys
+import threading
+import time
+from collections import Counter, deque
+import pandas as pd
+
+
+# settings, changed with configure
+ENABLED = False
+RESET_PEAK = False
+LOG_PATH = None
+PROFILE = False
+PROFILE_INTERVAL = 0.005
+PROFILE_TOP = 15
+
+# in-memory registry of the records of the last calls
+REGISTRY = deque(maxlen=100000)
+
+_local = threading.local()
+_log_lock = threading.Lock()
+
+
+def configure(enabled=None, log_path=None, profile=None, profile_interval=None, max_records=None,
+              reset_peak=None):
+    '''
+    Changes the settings of the instrumentation (settings which are None are not changed).
+
+    Parameters
+    ---------------
+    :enabled: if True, calls are recorded, if False, instrumented functions are called without recording
+            anything (default)
+    :log_path: if not None, path of a JSON lines file every record is appended to ("" to stop logging)
+    :profile: if True, the top-level instrumented calls are sampled by a profiler thread and the most frequent
+            functions are added to their records (slows down the calls)
+    :profile_interval: time between two samples of the profiler in seconds
+    :max_records: number of records kept in the registry
+    :reset_peak: if True, the peak resident set size of the process (VmHWM) is reset before every top-level
+            call, else it is only read before and after the calls
+    '''
+    global ENABLED, RESET_PEAK, LOG_PATH, PROFILE, PROFILE_INTERVAL, REGISTRY
+    if enabled is not None:
+        ENABLED = enabled
+    if reset_peak is not None:
+        RESET_PEAK = reset_peak
+    if log_path is not None:
+        LOG_PATH = log_path or None
+    if profile is not None:
+        PROFILE = profile
+    if profile_interval is not None:
+        PROFILE_INTERVAL = profile_interval
+    if max_records is not None:
+        REGISTRY = deque(REGISTRY, maxlen=max_records)
+
+
+def read_proc_status(key):
+    # value of key (e.g. "VmHWM", "VmRSS") in /proc/self/status in bytes, None if not available (not Linux)
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith(key + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+def reset_peak_rss():
+    # resets the peak resident set size (VmHWM) of the process (Linux >= 4.0), returns False if not possible
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def count_rows(value):
+    # number of rows of a dataframe/series/array/list, for tuples (e.g. (aligned, not_aligned)) of the
+    # first element, None for other values
+    if isinstance(value, tuple) and value:
+        value = value[0]
+    if isinstance(value, (pd.DataFrame, pd.Series, list, dict, set)) or hasattr(value, "shape"):
+        try:
+            return len(value)
+        except TypeError:
+            return None
+    return None
+
+
+class _Sampler(threading.Thread):
+    # samples the stack of one thread at regular intervals and counts the functions on it
+
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = 0
+        self.own = Counter()
+        self.cumulative = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.samples += 1
+            self.own[self._location(frame)] += 1
+            seen = set()
+            while frame is not None:
+                location = self._location(frame)
+                if location not in seen:
+                    seen.add(location)
+                    self.cumulative[location] += 1
+                frame = frame.f_back
+
+    @staticmethod
+    def _location(frame):
+        code = frame.f_code
+        return f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})"
+
+    def result(self, top):
+        # share of the samples per function: "own" (function was running) and "cumulative" (on the stack)
+        if not self.samples:
+            return {"samples": 0, "own": {}, "cumulative": {}}
+        return {"samples": self.samples,
+                "own": {location: count / self.samples for location, count in self.own.most_common(top)},
+                "cumulative": {location: count / self.samples
+                            for location, count in self.cumulative.most_common(top)}}
+
+
+def _stack():
+    # stack of the records of the active calls/blocks of the current thread
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def add_counters(**counters):
+    '''
+    Adds counters (e.g. cache_hits=10, cache_misses=2) to the record of the innermost active instrumented
+    call or block of the current thread, does nothing if there is none.
+    '''
+    stack = _stack()
+    if not stack:
+        return
+    record_counters = stack[-1]["counters"]
+    for key, value in counters.items():
+        record_counters[key] = record_counters.get(key, 0) + value
+
+
+class track:
+    '''
+    Context manager which records a block of code (the same way as an instrumented function).
+    The record is returned by "with track(...) as record", so row counts and counters can be set inside
+    the block (record["rows_out"] = ..., add_counters(...)).
+
+    Parameters
+    ---------------
+    :name: name of the record
+    :rows_in: number of input rows
+    '''
+
+    def __init__(self, name, rows_in=None):
+        self.name = name
+        self.rows_in = rows_in
+        self.record = None
+
+    def __enter__(self):
+        if not ENABLED:
+            return {"counters": {}}
+        stack = _stack()
+        top_level = not stack
+        self.record = {"name": self.name, "start": time.time(), "depth": len(stack), "wall_time": None,
+                    "rows_in": self.rows_in, "rows_out": None, "peak_rss_mb": None, "rss_increase_mb": None,
+                    "counters": {}, "error": None}
+        # the peak memory is only reset for top-level calls (if RESET_PEAK), nested calls report the peak
+        # since then
+        self._reset = RESET_PEAK and top_level and reset_peak_rss()
+        self._peak_before = read_proc_status("VmHWM")
+        self._use_rss = self._peak_before is not None
+        self._rss_before = read_proc_status("VmRSS") if self._use_rss else None
+        self._sampler = None
+        if PROFILE and top_level:
+            self._sampler = _Sampler(threading.get_ident(), PROFILE_INTERVAL)
+            self._sampler.start()
+        stack.append(self.record)
+        self._start = time.perf_counter()
+        return self.record
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.record is None:
+            return False
+        record = self.record
+        record["wall_time"] = time.perf_counter() - self._start
+        _stack().pop()
+        if self._use_rss:
+            peak = read_proc_status("VmHWM")
+            record["peak_rss_mb"] = peak / 2**20
+            # without reset, the increase is only known if the peak of the process was raised during the call
+            if self._reset or peak > self._peak_before:
+                record["rss_increase_mb"] = max(peak - self._rss_before, 0) / 2**20
+        if self._sampler is not None:
+            self._sampler.stopped.set()
+            self._sampler.join()
+            record["profile"] = self._sampler.result(PROFILE_TOP)
+        if exc_type is not None:
+            record["error"] = exc_type.__name__
+        _store(record)
+        return False
+
+
+def _store(record):
+    # adds a record to the registry and the log file
+    REGISTRY.append(record)
+    if LOG_PATH is not None:
+        line = json.dumps(record, default=str)
+        with _log_lock, open(LOG_PATH, "a") as log:
+            log.write(line + "\n")
+
+
+def instrument(function=None, name=None, caches=()):
+    '''
+    Decorator which records every call of the function (see track): the input rows are counted on the
+    first argument, the output rows on the return value (first element of returned tuples).
+
+    Parameters
+    ---------------
+    :function: decorated function (when used as @instrument)
+    :name: name of the records, default: module.function
+    :caches: functions decorated with functools.lru_cache, whose hits and misses during the call are added
+            to the counters "cache_hits" and "cache_misses"
+    '''
+    if function is None:
+        return functools.partial(instrument, name=name, caches=caches)
+    record_name = name or f"{function.__module__}.{function.__qualname__}"
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not ENABLED:
+            return function(*args, **kwargs)
+        with track(record_name, rows_in=count_rows(args[0]) if args else None) as record:
+            infos = [cache.cache_info() for cache in caches]
+            result = function(*args, **kwargs)
+            record["rows_out"] = count_rows(result)
+            for cache, before in zip(caches, infos):
+                after = cache.cache_info()
+                add_counters(cache_hits=after.hits - before.hits, cache_misses=after.misses - before.misses)
+        return result
+    return wrapper
+
+
+def get_records(name=None):
+    '''
+    Returns the records of the registry as a pandas dataframe (one row per call, the counters as columns,
+    the column "profile" contains the result of the sampling profiler for profiled calls).
+
+    Parameters
+    ---------------
+    :name: if not None, only the records with this name
+    '''
+    records = [record for record in REGISTRY if name is None or record["name"] == name]
+    df = pd.DataFrame(records, columns=["name", "start", "depth", "wall_time", "rows_in", "rows_out",
+                                        "peak_rss_mb", "rss_increase_mb", "counters", "error", "profile"])
+    counters = pd.DataFrame(df["counters"].tolist(), index=df.index)
+    return pd.concat([df.drop(columns="counters"), counters], axis=1)
+
+
+def summary():
+    '''
+    Aggregates the records of the registry per name: number of calls, total/mean/max wall time, rows,
+    throughput (input rows per second), maximal peak RSS and the cache hit rate (if there are cache counters).
+
+    Returns
+    ---------------
+    pandas dataframe with one row per name, sorted by total wall time
+    '''
+    records = get_records()
+    if records.empty:
+        return pd.DataFrame()
+    for column in ["cache_hits", "cache_misses"]:
+        if column not in records:
+            records[column] = 0
+    grouped = records.groupby("name")
+    table = pd.DataFrame({
+        "calls": grouped.size(),
+        "total_time": grouped["wall_time"].sum(),
+        "mean_time": grouped["wall_time"].mean(),
+        "max_time": grouped["wall_time"].max(),
+        "rows_in": grouped["rows_in"].sum(min_count=1),
+        "rows_out": grouped["rows_out"].sum(min_count=1),
+        "max_peak_rss_mb": grouped["peak_rss_mb"].max(),
+        "errors": grouped["error"].count(),
+    })
+    table["rows_per_second"] = table["rows_in"] / table["total_time"]
+    lookups = grouped["cache_hits"].sum() + grouped["cache_misses"].sum()
+    table["cache_hit_rate"] = (grouped["cache_hits"].sum() / lookups).where(lookups > 0)
+    return table.sort_values("total_time", ascending=False)
+
+
+def clear():
+    # removes all records from the registry
+    REGISTRY.clear()
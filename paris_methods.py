@@ -1,11 +1,13 @@
 import pandas as pd
-from shapely.ops import linemerge
 import numpy as np
 from scipy.sparse import csr_matrix
 from scipy.sparse.csgraph import connected_components
-from pyproj import Proj, transform
-import geopandas as gpd
-import matplotlib.pyplot as plt
+from scipy.special import xlogy
+from shapely.strtree import STRtree
+import shapely
+from shapely import get_x, get_y
+from functools import lru_cache
+from instrumentation import instrument
 
 
 def add_overlap_indices(Dataframe, current_row, comparing_row):
@@ -27,126 +29,271 @@ def same_identifier(row, identifier):
 
 def merge_streets(Dataframe):
     # Creates one representative containing combined all matching streets and all "match identifiers"
-    new_geometry = Dataframe.iloc[0].geometry
-    new_identifiers = []
-    new_year = []
-    Dataframe.apply(lambda row: linemerge([new_geometry, row.geometry]),axis=1)
-    Dataframe.apply(lambda row: new_identifiers.extend(row.matching), axis=1)
-    Dataframe.apply(lambda row: new_year.extend(row.year), axis=1)
-
-    # Define representative
-    representative = Dataframe.iloc[0]
-    representative.geometry = new_geometry
-    representative.matching = new_identifiers
-    representative.year = new_year
-    return(representative)
+    # (geometry: all street geometries merged, see merge_street_groups)
+    return merge_street_groups(Dataframe, np.zeros(len(Dataframe), dtype=np.int64)).iloc[0]
 
 def merge_streets_final(Dataframe):
     # Creates one representative containing combined all matching streets and all "match identifiers"
-    new_identifiers = []
-    new_year = []
-    Dataframe.apply(lambda row: new_identifiers.extend(row.matching), axis=1)
-    Dataframe.apply(lambda row: new_year.extend(row.year), axis=1)
-
-    # Define representative
-    representative = Dataframe.iloc[0]
-    representative.geometry = Dataframe.iloc[0,:].geometry
-    representative.matching = new_identifiers
-    representative.year = new_year
-    return(representative)
+    # (geometry: the one of the first street)
+    return merge_street_groups(Dataframe, np.zeros(len(Dataframe), dtype=np.int64), merge_geometry=False).iloc[0]
 
-def duplicate_processing(Dataframe, streetcolumn):
-
-    # Initialisation
-    streetnames = Dataframe[streetcolumn].unique()
-    Dataframe["matching"] = pd.np.empty((len(Dataframe), 0)).tolist()
-
-    # For each street name
-    for streetname in streetnames:
-        ## Filter DF for street name and create new temporary Dataframe
-        filter = Dataframe[streetcolumn] == streetname
-        MatchingStreetname = Dataframe[filter]
-        # remove values from main dataframe
-        Dataframe = Dataframe[~filter]
-        
-        # Add indices of streets that overlap
-        for comparing_row in range(0,len(MatchingStreetname)):
-            MatchingStreetname.apply(lambda current_row: add_overlap_indices(MatchingStreetname, current_row, comparing_row), axis=1)
-
-        ## Merge all streets with overlapping segments
-        for identifier in MatchingStreetname.IDENTIFI:
-            # Create temporary dataframe with all streets that intersect that index
-            MatchingStreetname["filter"] = MatchingStreetname.apply(lambda current_row: same_identifier(current_row, identifier), axis=1)
-            MatchingIndex = MatchingStreetname[MatchingStreetname["filter"]]
-            # Only work with dataframes having more than one street
-            if len(MatchingIndex) == 1:
-                pass
-            else:
-                # remove all streets with index from MatchingStreet DF
-                MatchingStreetname = MatchingStreetname[~MatchingStreetname["filter"]]
-
-                # Create one representative containing all values of streets with same index
-                representative = merge_streets(MatchingIndex)
-
-                # Add one representative back to MatchingStreet DF
-                representative = pd.Series.to_frame(representative).T
-                MatchingStreetname = pd.concat([MatchingStreetname,representative])
-        # Add all representatives back to Main Dataframe
-
-        Dataframe = pd.concat([Dataframe, MatchingStreetname])
+def merge_group_geometries(geometries, groups):
+    '''
+    Merges the (Multi)LineStrings of every group into one LineString (or MultiLineString, if the lines
+    of the group are not connected), for all groups in one vectorized call (shapely.multilinestrings with
+    the group labels as indices, then shapely.line_merge).
 
-    return Dataframe
+    Parameters
+    ---------------
+    :geometries: array or Series of LineStrings/MultiLineStrings (missing geometries are skipped)
+    :groups: array of integer group labels from 0 to number of groups - 1, same length as geometries
 
+    Returns
+    ---------------
+    numpy array with the merged geometry of every group (None for groups without geometry)
+    '''
+    groups = np.asarray(groups)
+    n_groups = int(groups.max()) + 1 if len(groups) else 0
+    parts, part_index = shapely.get_parts(np.asarray(geometries, dtype=object), return_index=True)
+    if not np.isin(shapely.get_type_id(parts), [1, 2]).all():
+        raise ValueError("only LineStrings and MultiLineStrings can be merged")
+    part_groups = groups[part_index]
+    order = np.argsort(part_groups, kind="stable")
+    merged = np.full(n_groups, None, dtype=object)
+    shapely.multilinestrings(parts[order], indices=part_groups[order], out=merged)
+    return shapely.line_merge(merged)
+
+def _concat_group_lists(values, groups, n_groups):
+    # concatenates the lists in values per group (in row order), with one explode and one stable sort
+    values = pd.Series(values, dtype=object)
+    lengths = values.str.len().fillna(0).to_numpy(dtype=np.int64)
+    flat = values.explode().to_numpy(dtype=object)[np.repeat(lengths > 0, np.maximum(lengths, 1))]
+    flat = flat[np.argsort(np.repeat(groups, lengths), kind="stable")]
+    ends = np.cumsum(np.bincount(groups, weights=lengths, minlength=n_groups).astype(np.int64))
+    return [group_values.tolist() for group_values in np.split(flat, ends[:-1])]
+
+@instrument
+def merge_street_groups(Dataframe, groups, merge_geometry=True, list_columns=("matching", "year")):
+    '''
+    Merges every group of streets (e.g. duplicates) into one representative, for all groups at once. The
+    representative keeps the values of the first street of its group, the lists in list_columns of all
+    streets of the group are concatenated and (if merge_geometry) the geometries are merged with
+    merge_group_geometries.
 
-def duplicate_final(Dataframe, streetcolumn):
+    Parameters
+    ---------------
+    :Dataframe: (geo)pandas dataframe with the streets, needs the columns in list_columns (lists, e.g. "match
+                identifiers" and years) and "geometry" (LineStrings) if merge_geometry
+    :groups: array of group labels (no missing values), same length as Dataframe
+    :merge_geometry: if True, the geometry of the representative is the merged geometry of the group,
+                else the one of its first street
+    :list_columns: columns with lists which are concatenated
 
-    # Initialisation
-    streetnames = Dataframe[streetcolumn].unique()
-    Dataframe["matching"] = pd.np.empty((len(Dataframe), 0)).tolist()
+    Returns
+    ---------------
+    dataframe with one row per group, in the order of the first street of every group
+    '''
+    codes, uniques = pd.factorize(np.asarray(groups))
+    if len(codes) and codes.min() < 0:
+        raise ValueError("groups must not contain missing values")
+    # factorize numbers the groups in order of appearance, so the first rows are in row order
+    _, first = np.unique(codes, return_index=True)
+    Result = Dataframe.iloc[first].copy()
+    for column in list_columns:
+        Result[column] = pd.Series(_concat_group_lists(Dataframe[column].tolist(), codes, len(uniques)),
+                                    dtype=object).values
+    if merge_geometry:
+        Result["geometry"] = merge_group_geometries(Dataframe["geometry"].values, codes)
+    return Result
+
+def get_overlap_pairs(geometries, groups=None):
+    '''
+    Finds all pairs of intersecting geometries with one bulk query on a spatial index (STRtree),
+    instead of calling intersects for every pair of geometries.
 
-    for streetname in streetnames:
-        ## Filter DF for street name and create new temporary Dataframe
-        filter = Dataframe[streetcolumn] == streetname
-        MatchingStreetname = Dataframe[filter]
-        # remove values from main dataframe
-        Dataframe = Dataframe[~filter]
-        
-        # Add indices of streets that overlap
-        for comparing_row in range(0,len(MatchingStreetname)):
-            MatchingStreetname.apply(lambda current_row: add_overlap_final(MatchingStreetname, current_row, comparing_row), axis=1)
+    Parameters
+    ---------------
+    :geometries: list, array or Series of geometry objects (in our case: buffered streets)
+    :groups: if not None, array of group labels (e.g. codes of the street names), same length as geometries;
+            only pairs of geometries with the same label are returned
 
-        ## Merge all streets with overlapping segments
-        for identifier in MatchingStreetname.rowid:
-            # Create temporary dataframe with all streets that intersect that index
-            MatchingStreetname["filter"] = MatchingStreetname.apply(lambda current_row: same_identifier(current_row, identifier), axis=1)
-            MatchingIndex = MatchingStreetname[MatchingStreetname["filter"]]
-            # Only work with dataframes having more than one street
-            if len(MatchingIndex) == 1:
-                pass
-            else:
-                # remove all streets with index from MatchingStreet DF
-                MatchingStreetname = MatchingStreetname[~MatchingStreetname["filter"]]
+    Returns
+    ---------------
+    :left, right: numpy arrays of positions, (left[k], right[k]) is a pair of intersecting geometries
+                (contains (i,j) as well as (j,i) and (i,i)), sorted by left and then by right
+    '''
+    geometries = np.asarray(geometries, dtype=object)
+    tree = STRtree(geometries)
+    left, right = tree.query(geometries, predicate="intersects")
+    if groups is not None:
+        groups = np.asarray(groups)
+        same_group = groups[left] == groups[right]
+        left, right = left[same_group], right[same_group]
+    order = np.lexsort((right, left))
+    return left[order], right[order]
+
+
+def _merge_component(positions, identifiers, matching, years):
+    # Replays the sequential merging of the former row-by-row implementation on one group of
+    # connected streets: for each identifier (in row order), all streets containing it in their 
+    # "matching" list are replaced by one representative, which is appended at the end.
+    # Returns position of the representative's row, its matching and year lists, and the position
+    # of the identifier whose merge created it.
+    items = [(pos, list(matching[pos]), list(years[pos]), set(matching[pos])) for pos in positions]
+    created = positions[0]
+    for pos in positions:
+        identifier = identifiers[pos]
+        holders = [item for item in items if identifier in item[3]]
+        if len(holders) > 1:
+            items = [item for item in items if identifier not in item[3]]
+            new_identifiers, new_year, new_set = [], [], set()
+            for _, item_matching, item_year, item_set in holders:
+                new_identifiers.extend(item_matching)
+                new_year.extend(item_year)
+                new_set.update(item_set)
+            items.append((holders[0][0], new_identifiers, new_year, new_set))
+            created = pos
+    representative, new_identifiers, new_year, _ = items[0]
+    return representative, new_identifiers, new_year, created
+
+
+@instrument
+def merge_overlapping_streets(Dataframe, streetcolumn, idcolumn, merge_geometry=False):
+    '''
+    Merges streets with the same name whose buffers overlap (directly or through other streets with
+    the same name) into one representative, which keeps the values of the first street and contains
+    the "match identifiers" and years of all merged streets.
+    The overlapping pairs are found with one spatial index query and grouped with connected_components,
+    the result is identical to the former row-by-row implementation (same rows, order, index and
+    "matching"/"year"/"filter" values), but the input dataframe is not altered.
 
-                # Create one representative containing all values of streets with same index
-                representative = merge_streets_final(MatchingIndex)
+    Parameters
+    ---------------
+    :Dataframe: (geo)pandas dataframe with the streets, needs the columns "buffer" (buffered street
+                geometries) and "year" (list of years)
+    :streetcolumn: name of the column with the street names
+    :idcolumn: name of the column with the identifiers of the streets (e.g. "IDENTIFI" or "rowid")
+    :merge_geometry: if True, the geometry of a representative is the merged geometry of all its streets
+                (see merge_group_geometries, needs LineStrings in the column "geometry") and its buffer
+                the union of their buffers, else both are the ones of the first street
 
-                # Add one representative back to MatchingStreet DF
-                representative = pd.Series.to_frame(representative).T
-                MatchingStreetname = pd.concat([MatchingStreetname,representative])
-        # Add all representatives back to Main Dataframe
+    Returns
+    ---------------
+    dataframe with one row per group of overlapping streets with the same name, containing the
+    additional column "matching" with the identifiers of all overlapping streets
+    '''
+    n = len(Dataframe)
+    codes, _ = pd.factorize(Dataframe[streetcolumn])
+    identifiers = Dataframe[idcolumn].tolist()
+    years = Dataframe["year"].tolist()
+    named = codes >= 0
+
+    # all pairs of overlapping streets with the same name
+    left, right = get_overlap_pairs(Dataframe["buffer"].values, codes)
+    keep = named[left]
+    left, right = left[keep], right[keep]
+
+    matching = [[] for _ in range(n)]
+    for i, j in zip(left.tolist(), right.tolist()):
+        matching[i].append(identifiers[j])
+
+    # streets with the same name and identifier are matched through their identifier as well
+    id_codes, _ = pd.factorize(Dataframe[idcolumn])
+    keys = pd.DataFrame({"name": codes, "id": id_codes, "position": np.arange(n)})[named]
+    first = keys.groupby(["name", "id"])["position"].transform("first").values
+    rows = np.concatenate([left, keys["position"].values])
+    cols = np.concatenate([right, first])
+    graph = csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(n, n))
+    _, labels = connected_components(csgraph=graph, directed=False, return_labels=True)
+
+    # merge every group of connected streets into one representative
+    # (sort key: street name, single streets before representatives, then creation order)
+    sort_keys, new_matching, new_years, members = {}, {}, {}, {}
+    positions = np.arange(n)[named]
+    component_order = np.argsort(labels[named], kind="stable")
+    split_at = np.flatnonzero(np.diff(labels[named][component_order])) + 1
+    for component in np.split(positions[component_order], split_at):
+        # (np.split gives one empty component if no street has a name)
+        if len(component) == 0:
+            continue
+        if len(component) == 1:
+            pos = component[0]
+            sort_keys[pos] = (codes[pos], 0, pos)
+            new_matching[pos], new_years[pos] = matching[pos], years[pos]
+        else:
+            pos, new_matching[pos], new_years[pos], created = _merge_component(
+                component.tolist(), identifiers, matching, years)
+            sort_keys[pos] = (codes[pos], 1, created)
+            members[pos] = component
+
+    # streets without name are not touched and stay at the beginning
+    unnamed = np.flatnonzero(~named).tolist()
+    representatives = sorted(sort_keys, key=sort_keys.get)
+    take = unnamed + representatives
+
+    # identifier of the last street per name, "filter" marks the streets which contain it
+    last_identifier = {code: identifiers[pos] for pos, code in enumerate(codes) if code >= 0}
+
+    Result = Dataframe.iloc[take].copy()
+    Result["matching"] = pd.Series([[] for _ in unnamed] + [new_matching[pos] for pos in representatives],
+                                    dtype=object).values
+    Result["year"] = pd.Series([years[pos] for pos in unnamed] + [new_years[pos] for pos in representatives],
+                                dtype=object).values
+    Result["filter"] = [np.nan for _ in unnamed] + \
+        [last_identifier[codes[pos]] in new_matching[pos] for pos in representatives]
+    if merge_geometry:
+        component_codes = np.full(n, -1, dtype=np.int64)
+        component_codes[named] = pd.factorize(labels[named])[0]
+        merged = merge_group_geometries(Dataframe["geometry"].values[named], component_codes[named])
+        Result["geometry"] = list(Dataframe["geometry"].values[unnamed]) + \
+            list(merged[component_codes[representatives]])
+        # the buffer of a representative is the union of the buffers of its streets, so it agrees with
+        # the merged geometry
+        buffers = Result["buffer"].array.copy()
+        for k, pos in enumerate(representatives, start=len(unnamed)):
+            if pos in members:
+                buffers[k] = shapely.union_all(Dataframe["buffer"].values[members[pos]])
+        Result["buffer"] = buffers
+    return Result
+
+
+@instrument
+def duplicate_processing(Dataframe, streetcolumn):
+    # Merges overlapping streets with the same name (identifiers in column "IDENTIFI"), the representatives
+    # get the merged geometry and the union of the buffers of their streets
+    return merge_overlapping_streets(Dataframe, streetcolumn, "IDENTIFI", merge_geometry=True)
 
-        Dataframe = pd.concat([Dataframe, MatchingStreetname])
 
-    return Dataframe
+@instrument
+def duplicate_final(Dataframe, streetcolumn):
+    # Merges overlapping streets with the same name (identifiers in column "rowid")
+    return merge_overlapping_streets(Dataframe, streetcolumn, "rowid")
 
 
 
-def assign_gridnumber(Dataframe, gridX, gridY):
+@instrument
+def assign_gridnumber(Dataframe, gridX, gridY, vectorized=True, raise_out_of_bounds=False, crs=None):
     # Assigns Streets to a given grid
-
-    # Translate in right coordinate system
-    #gridX = translate_geopoints(gridX)
-    #gridY = translate_geopoints(gridY)
+    # vectorized=True: bins all centroids at once (see get_gridnumber), grid columns are compact integers 
+    #                  and points outside of the grid get -1 (or raise a ValueError if raise_out_of_bounds)
+    # vectorized=False: row-by-row comparison, points outside of the grid get None
+    # crs: if not None, coordinate system of the centroids, which are then transformed to the coordinate
+    #      system of the grid (epsg:3857) in one call (only with vectorized=True)
+
+    if vectorized:
+        centroids = np.asarray(Dataframe["centroid"], dtype=object)
+        x, y = get_x(centroids), get_y(centroids)
+        # Translate in right coordinate system
+        if crs is not None:
+            x, y = reproject_coordinates(x, y, crs_from=crs, crs_to="epsg:3857", always_xy=True)
+        indexX, indexY, grid = get_gridnumber(x, y, gridX, gridY)
+        n_outside = int(np.sum(grid == -1))
+        if raise_out_of_bounds and n_outside:
+            raise ValueError(f"{n_outside} centroids lie outside of the grid")
+        Dataframe["gridY"] = indexY
+        Dataframe["gridX"] = indexX
+        Dataframe["grid"] = grid
+        return 0
 
     ## Check Y coordinates
     Dataframe["gridY"] = Dataframe.apply(lambda row: compare_point_y(row,gridY), axis=1)
@@ -155,6 +302,68 @@ def assign_gridnumber(Dataframe, gridX, gridY):
     Dataframe["grid"] = (Dataframe["gridY"]-1) * (len(gridX)-1) + Dataframe["gridX"]
     return 0
 
+
+def get_gridnumber(x, y, gridX, gridY):
+    '''
+    Bins points on the grid given by create_grid, for all points at once. As in compare_point_x/compare_point_y,
+    a point belongs to cell i if boundary[i-1] < coordinate <= boundary[i].
+
+    Parameters
+    ---------------
+    :x: array of x coordinates of the points
+    :y: array of y coordinates of the points
+    :gridX: list of grid boundaries on the x axis of the form [[0, x0], [0, x1], ...] (see create_grid)
+    :gridY: list of grid boundaries on the y axis of the form [[y0, 0], [y1, 0], ...] (see create_grid)
+
+    Returns
+    ---------------
+    :indexX: column of the grid for every point (starting at 1)
+    :indexY: row of the grid for every point (starting at 1)
+    :grid: grid number of every point, (indexY-1) * number of columns + indexX
+    all three as numpy arrays with the smallest integer type, -1 for points outside of the grid
+    (or without coordinates)
+    '''
+    boundariesX = np.array([float(boundary[1]) for boundary in gridX])
+    boundariesY = np.array([float(boundary[0]) for boundary in gridY])
+    n_columns = len(boundariesX) - 1
+    n_cells = n_columns * (len(boundariesY) - 1)
+
+    indexX = np.searchsorted(boundariesX, np.asarray(x, dtype=float), side="left")
+    indexY = np.searchsorted(boundariesY, np.asarray(y, dtype=float), side="left")
+    # index 0: point on/before first boundary, index len(boundaries): point after last boundary or NaN
+    outside = (indexX == 0) | (indexX == len(boundariesX)) | (indexY == 0) | (indexY == len(boundariesY))
+    grid = (indexY - 1) * n_columns + indexX
+
+    # smallest signed type holding the grid numbers up to n_cells (int8 holds -(n+1) exactly if it holds n)
+    dtype = np.promote_types(np.min_scalar_type(-(n_cells + 1)), np.int8)
+    indexX, indexY, grid = [np.where(outside, -1, index).astype(dtype) for index in (indexX, indexY, grid)]
+    return indexX, indexY, grid
+
+
+@instrument
+def grid_sweep(Dataframe, gridsizes):
+    '''
+    Assigns the centroids of a dataframe to square grids of different sizes (see create_grid), e.g. to
+    compare results over several grid resolutions. The centroid coordinates are only extracted once.
+
+    Parameters
+    ---------------
+    :Dataframe: dataframe with a column "centroid"
+    :gridsizes: list of integers, number of grid cells per axis
+
+    Returns
+    ---------------
+    dataframe with the same index as Dataframe and one column of grid numbers per gridsize
+    (-1 for centroids outside of the grid)
+    '''
+    centroids = np.asarray(Dataframe["centroid"], dtype=object)
+    x, y = get_x(centroids), get_y(centroids)
+    grids = {}
+    for gridsize in gridsizes:
+        gridX, gridY = create_grid(gridsize, gridsize, Dataframe)
+        grids[gridsize] = get_gridnumber(x, y, gridX, gridY)[2]
+    return pd.DataFrame(grids, index=Dataframe.index)
+
 def compare_point_x(row, gridX):
     point = float(row["centroid"].x)
     for index in range(1,len(gridX)):
@@ -173,48 +382,103 @@ def compare_point_y(row, gridY):
             return(int(index))
 
 
+@lru_cache(maxsize=None)
+def get_transformer(crs_from="epsg:4326", crs_to="epsg:3857", always_xy=False):
+    # Creates the transformer between two coordinate systems only once and reuses it
+    from pyproj import Transformer
+
+    return Transformer.from_crs(crs_from, crs_to, always_xy=always_xy)
+
+
+@instrument(caches=(get_transformer,))
+def reproject_coordinates(a, b, crs_from="epsg:4326", crs_to="epsg:3857", always_xy=False):
+    '''
+    Transforms arrays of coordinates from one coordinate system to another in one vectorized call.
+
+    Parameters
+    ---------------
+    :a, b: arrays of coordinates, in the axis order of crs_from (for epsg:4326: latitude, longitude),
+            or x/longitude and y/latitude if always_xy is True
+    :crs_from: coordinate system of the input coordinates
+    :crs_to: coordinate system of the output coordinates
+    :always_xy: if True, input and output coordinates are in the order x/longitude, y/latitude
+
+    Returns
+    ---------------
+    two numpy arrays with the transformed coordinates
+    '''
+    transformer = get_transformer(crs_from, crs_to, always_xy)
+    return transformer.transform(np.asarray(a, dtype=float), np.asarray(b, dtype=float))
+
+
+@instrument(caches=(get_transformer,))
+def reproject_geometries(geometries, crs_from, crs_to="epsg:3857"):
+    '''
+    Transforms a GeoSeries or a list/array of shapely geometries to another coordinate system, 
+    all coordinates are transformed in one call.
+
+    Parameters
+    ---------------
+    :geometries: GeoSeries, or list/array of shapely geometries
+    :crs_from: coordinate system of the geometries
+    :crs_to: coordinate system of the output geometries
+
+    Returns
+    ---------------
+    GeoSeries (with crs_to) if a GeoSeries was given, else numpy array of geometries
+    '''
+    import geopandas as gpd
+
+    if isinstance(geometries, gpd.GeoSeries):
+        return geometries.set_crs(crs_from, allow_override=True).to_crs(crs_to)
+    transformer = get_transformer(crs_from, crs_to, True)
+    return shapely.transform(np.asarray(geometries, dtype=object), 
+                            lambda coords: np.column_stack(transformer.transform(coords[:, 0], coords[:, 1])))
+
+
+@instrument
 def translate_geopoints(geopoints):
-    inProj = Proj('epsg:4326')
-    outProj = Proj('epsg:3857')
-    transformed = []
-    for index,value in enumerate(geopoints):
-        transformed.append(transform(inProj,outProj,value[0],value[1]))
-    return transformed
+    # Transforms points of the form [latitude, longitude] (epsg:4326) to epsg:3857
+    if len(geopoints) == 0:
+        return []
+    geopoints = np.asarray(geopoints, dtype=float)
+    x, y = reproject_coordinates(geopoints[:, 0], geopoints[:, 1])
+    return list(zip(x.tolist(), y.tolist()))
 
 
-def check_overlap(buffer_list):
+@instrument
+def check_overlap(buffer_list, return_labels=False):
     '''
     Checks if all streets in a buffer_list overlap. If they are all connected, return True, else return False.
+    The overlapping pairs are found with one spatial index query and stored in a sparse matrix.
 
     Parameters
     ---------------
     :buffer_list: list of geometry objects (in our case: list with buffered streets)
+    :return_labels: if True, also return the label of the connected group of every street
 
     Returns
     ---------------
     True: all streets/objects are connected (they overlap)
     False: there is at least one pair of streets which are not connected 
                                     (also not through other street(s) in buffer_list)
+    if return_labels: tuple (True/False, numpy array with the label of the connected group of each street)
     '''
     len_buffer = len(buffer_list)
-    # instantiate a numpy matrix which will store in entry (i,j) if street i and j overlap
-    intersects = np.zeros((len_buffer, len_buffer))
-
-    # go through each pair of streets and check if they overlap
-    for i in range(len_buffer):
-        for j in range(len_buffer):
-            # if street i and j overlap, write 1, otherwise 0
-            intersects[i,j] = int(buffer_list[i].intersects(buffer_list[j]))
-    
+    # pairs (i,j) of streets which overlap
+    left, right = get_overlap_pairs(buffer_list)
+    intersects = csr_matrix((np.ones(len(left)), (left, right)), shape=(len_buffer, len_buffer))
+
     # treat intersects matrix as adjacency matrix of a graph
     # if the graph is connected (n_components=1), all streets overlap
-    n_components = connected_components(csgraph=csr_matrix(intersects), directed=False, return_labels=False)
-    if n_components == 1:
-        return True
-    else:
-        return False
+    n_components, labels = connected_components(csgraph=intersects, directed=False, return_labels=True)
+    all_overlap = n_components == 1
+    if return_labels:
+        return all_overlap, labels
+    return all_overlap
 
 
+@instrument
 def create_grid(y_steps, x_steps, Dataframe):
    # Creates a evenly spaced grid with the given parameters
  
@@ -235,9 +499,44 @@ def create_grid(y_steps, x_steps, Dataframe):
     return gridX, gridY
 
 
+@instrument
+def create_grid_from_extent(y_steps, x_steps, extent, crs="epsg:3857"):
+    '''
+    Creates an evenly spaced grid in epsg:3857 over a fixed extent (e.g. the map extent analysis.PARIS_EXTENT),
+    in the same format as create_grid. Points on the western/southern border do not belong to the grid.
+
+    Parameters
+    ---------------
+    :y_steps: number of grid cells on the y axis
+    :x_steps: number of grid cells on the x axis
+    :extent: tuple (west, south, east, north)
+    :crs: coordinate system of the extent, if it is not epsg:3857 (e.g. "epsg:4326" for longitude/latitude),
+            the corners are transformed to epsg:3857
+
+    Returns
+    ---------------
+    :gridX: list of grid boundaries on the x axis of the form [[0, x0], [0, x1], ...]
+    :gridY: list of grid boundaries on the y axis of the form [[y0, 0], [y1, 0], ...]
+    '''
+    west, south, east, north = extent
+    if crs != "epsg:3857":
+        (west, east), (south, north) = reproject_coordinates([west, east], [south, north], crs_from=crs, 
+                                                            crs_to="epsg:3857", always_xy=True)
+    gridY = [[y, 0] for y in np.linspace(south, north, y_steps+1)]
+    gridX = [[0, x] for x in np.linspace(west, east, x_steps+1)]
+    return gridX, gridY
+
+
+@instrument
 def get_change_over_years(df, yearcolumn="annee_bin"):
 # function that creates dataframe with all jobs for a given bin and assigns jobs to that bin
     pivot = pd.pivot_table(df, values= "rue", index= "tags", columns = yearcolumn, aggfunc="count")
+    return get_change_from_pivot(pivot)
+
+
+def get_change_from_pivot(pivot):
+    # change of the professional mix between consecutive years, computed on a table with the number of entries
+    # per tag (rows, sorted) and year (columns, sorted), e.g. of get_change_over_years or cube.cube_change_over_years
     pivot = pivot.fillna(0)
     pivot = pivot.iloc[1:,1:]
     pivot_rel = pivot.apply(lambda col: col/sum(col))
@@ -245,4 +544,114 @@ def get_change_over_years(df, yearcolumn="annee_bin"):
     for year in range(1, len(pivot_rel.columns)):
         dif = sum(abs(pivot_rel.iloc[:,year] - pivot_rel.iloc[:,year-1]))/2
         change_year.append(dif)
-    return(change_year, pivot.columns[1:])
\ No newline at end of file
+    return(change_year, pivot.columns[1:])
+
+
+def _window_sums(matrix, window):
+    # sums of window consecutive columns, column j: sum of the columns j, ..., j+window-1
+    cumulated = np.cumsum(np.pad(matrix, ((0, 0), (1, 0))), axis=1)
+    return cumulated[:, window:] - cumulated[:, :-window]
+
+
+def _distribution_distance(p, q, distance):
+    # terms of the distance between the distributions p and q (one term per tag, summed per location)
+    m = p + q
+    if distance == "tv":
+        return np.abs(p - q) / 2
+    if distance == "js":
+        # Jensen-Shannon divergence in bits (between 0 and 1), 0 * log(0) = 0
+        ratio_p = np.divide(2 * p, m, out=np.ones_like(m), where=m > 0)
+        ratio_q = np.divide(2 * q, m, out=np.ones_like(m), where=m > 0)
+        return (xlogy(p, ratio_p) + xlogy(q, ratio_q)) / (2 * np.log(2))
+    if distance == "chi2":
+        # symmetric chi-square distance (between 0 and 1)
+        return np.divide((p - q) ** 2, 2 * m, out=np.zeros_like(m), where=m > 0)
+    raise ValueError(f"unknown distance {distance}, use 'tv', 'js' or 'chi2'")
+
+
+@instrument
+def get_distribution_changes(locations, tags, years, counts=None, bin_width=None, start=None, window=1,
+                            distance="tv", exclude_tags=None):
+    '''
+    Change of the professional mix between consecutive year bins, for all locations (e.g. streets or grid cells)
+    at once. get_change_over_years is the total variation distance for all of Paris with bins of one decade (but
+    without its first tag and first bin). Only the (location, tag) pairs which occur are stored, as array of
+    pairs x bins, so thousands of locations and tags do not need a dense locations x tags x bins array.
+
+    Parameters
+    ---------------
+    :locations: array of the location of every entry (e.g. street ids or grid numbers)
+    :tags: array of the profession tag of every entry
+    :years: array of the year of every entry (or of its bin, e.g. "annee_bin")
+    :counts: if not None, number of entries of every row (e.g. the "count" column of the cube)
+    :bin_width: if not None, the years are put in bins of bin_width years (starting at start), including
+                bins without entries, else every distinct value of years is a bin
+    :start: first year of the bins (default: smallest year)
+    :window: number of bins summed on each side of a transition (sliding windows), 1: consecutive bins
+    :distance: "tv" (total variation distance), "js" (Jensen-Shannon divergence) or "chi2" (symmetric
+                chi-square distance), all between 0 (same mix) and 1 (no profession in common)
+    :exclude_tags: if not None, list of tags which are not counted (e.g. [""] for entries without profession)
+
+    Returns
+    ---------------
+    :changes: numpy array of shape (number of locations, number of transitions), NaN if a window of the
+            location has no entries
+    :location_values: locations of the rows (sorted)
+    :transition_years: first bin after every transition (like the years of get_change_over_years)
+    '''
+    locations, tags, years = pd.Series(locations).to_numpy(), pd.Series(tags).to_numpy(), pd.Series(years)
+    counts = np.ones(len(locations)) if counts is None else np.asarray(counts, dtype=float)
+    valid = pd.notna(locations) & pd.notna(tags) & years.notna().to_numpy()
+    if exclude_tags is not None:
+        valid &= ~pd.Series(tags).isin(list(exclude_tags)).to_numpy()
+    locations, tags, counts = locations[valid], tags[valid], counts[valid]
+    years = years[valid].astype(float).to_numpy()
+
+    if bin_width is not None:
+        start = np.nanmin(years) if start is None else start
+        bin_codes = ((years - start) // bin_width).astype(np.int64)
+        bins = start + bin_width * np.arange(bin_codes.max() + 1 if len(bin_codes) else 0)
+        if (bin_codes < 0).any():
+            raise ValueError("years before start")
+    else:
+        bin_codes, bins = pd.factorize(years, sort=True)
+    n_bins = len(bins)
+    if n_bins < 2 * window:
+        raise ValueError(f"{n_bins} bins are not enough for windows of {window} bins")
+
+    location_codes, location_values = pd.factorize(locations, sort=True)
+    tag_codes, tag_values = pd.factorize(tags, sort=True)
+    # (location, tag) pairs sorted by location, counts of every pair per bin
+    pair_codes, pairs = pd.factorize(location_codes.astype(np.int64) * len(tag_values) + tag_codes, sort=True)
+    pair_locations = pairs // len(tag_values)
+    pair_counts = np.bincount(pair_codes * n_bins + bin_codes, weights=counts, 
+                            minlength=len(pairs) * n_bins).reshape(len(pairs), n_bins)
+
+    windows = _window_sums(pair_counts, window)
+    n_transitions = n_bins - 2 * window + 1
+    before, after = windows[:, :n_transitions], windows[:, window:window + n_transitions]
+    location_starts = np.flatnonzero(np.r_[True, pair_locations[1:] != pair_locations[:-1]])
+    totals_before = np.add.reduceat(before, location_starts, axis=0)
+    totals_after = np.add.reduceat(after, location_starts, axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        p = np.nan_to_num(before / totals_before[pair_locations])
+        q = np.nan_to_num(after / totals_after[pair_locations])
+    changes = np.add.reduceat(_distribution_distance(p, q, distance), location_starts, axis=0)
+    changes[(totals_before == 0) | (totals_after == 0)] = np.nan
+    return changes, np.asarray(location_values), np.asarray(bins)[window:window + n_transitions]
+
+
+@instrument
+def get_change_matrix(df, location_column, tag_column="tags", year_column="annee_bin", **kwargs):
+    '''
+    get_distribution_changes on the columns of a dataframe, e.g. get_change_matrix(rich_data, "street_id") for
+    the changes of every street or get_change_matrix(rich_data, "grid", year_column="annee", bin_width=5,
+    distance="js") for every grid cell.
+
+    Returns
+    ---------------
+    pandas dataframe with the locations as rows and the first bin after every transition as columns
+    '''
+    changes, location_values, transition_years = get_distribution_changes(
+        df[location_column], df[tag_column], df[year_column], **kwargs)
+    return pd.DataFrame(changes, index=pd.Index(location_values, name=location_column), columns=transition_years)
@@ -0,0 +1,607 @@
+'''
+Runs the steps of the notebooks (Preprocessing, Street_processing, Alignment, Analysis) headless as a
+pipeline of stages. Every stage declares the files it reads and writes; a stage is skipped if its inputs,
+its code and its parameters did not change since its last successful run (the content hashes are stored
+in data/.pipeline_state.json), and stages which do not depend on each other run in parallel processes.
+
+Usage
+---------------
+python pipeline.py                          # run all stages whose inputs changed
+python pipeline.py --list                   # show the stages and whether they are up to date
+python pipeline.py --stages alignment       # run the alignment (and the stages it depends on, if needed)
+python pipeline.py --stages alignment --force
+python pipeline.py --untagged --jobs 2      # use strict_addressing.csv (without the analysis stages)
+'''
+import argparse
+import hashlib
+import inspect
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, Future, FIRST_COMPLETED, wait
+import numpy as np
+import pandas as pd
+# headless plotting; geopandas and matplotlib are only imported by the stages which need them, so workers
+# of the other stages start faster
+os.environ.setdefault("MPLBACKEND", "Agg")
+
+from preprocessing import preprocess, get_prefix_dict, ingest_bottins, read_bottins, MANUAL_SUBSTITUTION, \
+    substitute_col_by_dict, StringNormalizer
+from paris_methods import duplicate_processing, duplicate_final, check_overlap
+from alignment import align_cascade, get_cached_fuzzy_dicts, add_street_ids, WORD_SUBSTITUTION, NO_SPACES_SUBSTITUTION
+from analysis import parse_tags, plot_ratio_over_time, gif_for_professions, get_basemap
+from cube import build_cube, expand_cube, cube_top_names, cube_ratio_over_time, cube_change_over_years, get_annee_bin
+from storage import read_dataset, write_dataset
+
+
+STATE_FILE = ".pipeline_state.json"
+
+# folder of the python files, the code files of the stages are relative to it
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# professions shown in the gifs of Analysis.ipynb
+GIF_PROFESSIONS = {
+    "food": ["boucher", "boulanger", "épicier", "charcutier"],
+    "housing": ["rentier", "propriétaire"],
+    "mobility": ["automobiles", "garage", "cycles", "bicyclettes"],
+}
+
+
+class Stage:
+    '''
+    A step of the pipeline: function(inputs, outputs, **params) reads the files in inputs and writes
+    the files in outputs (both dictionaries {role: path}).
+
+    Parameters
+    ---------------
+    :name: name of the stage
+    :function: function executing the stage
+    :inputs: dictionary {role: path} of files/folders the stage reads
+    :outputs: dictionary {role: path} of files/folders the stage writes
+    :code: python files the stage depends on, relative to CODE_DIR (a change reruns the stage)
+    :params: additional keyword arguments of function (a change reruns the stage)
+    '''
+
+    def __init__(self, name, function, inputs, outputs, code=(), params=None):
+        self.name = name
+        self.function = function
+        self.inputs = dict(inputs)
+        self.outputs = dict(outputs)
+        self.code = [os.path.join(CODE_DIR, path) for path in code]
+        self.params = dict(params or {})
+
+    def __repr__(self):
+        return f"Stage({self.name})"
+
+
+# stage functions (ported from the notebooks, without the exploration and plotting cells)
+
+def run_preprocessing(inputs, outputs, tagged=True):
+    # Preprocessing.ipynb: preprocesses the bottin streets and substitutes abbreviations
+    prefix_dict = get_prefix_dict(pd.read_csv(inputs["voies"], sep=";"))
+    if tagged:
+        rename = {"name": "nom", "métier_from_ocr": "metier", "numéro": "numero"}
+    else:
+        rename = {"Rue": "rue", "Nom": "nom", "Métier": "metier", "Numéro": "numero", "Unnamed: 0": "gallica_ark"}
+    ingest_bottins(inputs["bottins"], outputs["bottins_prep"], street_column="rue", rename=rename,
+                   substitutions=[prefix_dict, MANUAL_SUBSTITUTION, {"  ": " "}], overwrite=True)
+
+
+def run_street_processing(inputs, outputs, buffer=100, seed=0):
+    # Street_processing.ipynb: merges the Vasserot (1836) and Open Data (2022) streets
+    import geopandas as gpd
+
+    Openparis = gpd.read_file(inputs["openparis"], encoding = 'utf-8').to_crs(epsg=3857)
+    Vasserot = gpd.read_file(inputs["vasserot"]).to_crs(epsg=3857)
+
+    #change mistakes in streetnames
+    mask = Vasserot.loc[:,"NOM_ENTIER"] == "Rue Lafayette"
+    Vasserot.loc[mask,["NOM","NOM_ENTIER"]] = ["la Fayette", "Rue la Fayette"]
+
+    Openparis = preprocess(Openparis, "l_longmin")
+    Vasserot = preprocess(Vasserot, "NOM_ENTIER")
+    Vasserot["voie"] = Vasserot["NOM_ENTIER_prep"]
+    Openparis["voie"] = Openparis["l_longmin_prep"]
+    Vasserot = Vasserot.dropna(subset=["voie"])
+    Vasserot = Vasserot.assign(year= [[1836]]*len(Vasserot))
+    Openparis = Openparis.assign(year= [[2022]]*len(Openparis))
+    # create buffer around streets, important for merging duplicate streets
+    Vasserot["buffer"] = Vasserot["geometry"].buffer(buffer)
+    Openparis["buffer"] = Openparis["geometry"].buffer(buffer)
+
+    # merge duplicates of the 1836 streets if they are close
+    Duplicates = Vasserot[Vasserot.duplicated(subset=['voie'], keep=False)].sort_values("voie")
+    Unique = Vasserot[~Vasserot.duplicated(subset=['voie'], keep=False)].sort_values("voie")
+    DuplicatesProcessed = duplicate_processing(Duplicates, "voie")
+    NewlyUnique = DuplicatesProcessed[~DuplicatesProcessed.duplicated(subset=['voie'], keep=False)].sort_values("voie")
+    Unique = pd.concat([Unique, NewlyUnique])
+
+    # dataset containing old and new streets
+    Unique = Unique.iloc[:,[0,2,3,6,8,14,16,17,18]]
+    Unique = Unique.rename(columns={"ROWID":"rowid", "NOM_ENTIER":"streetname","TYPE":"type","ARTICLE":"article",
+                                    "NOM":"name", "voie":"streetname_prep"})
+    Unique = Unique.assign(matching = [[]] * len(Unique))
+    Openparis = Openparis.iloc[:,[2,3,4,5,6,15,17,18,19]]
+    Openparis = Openparis.rename(columns={"l_longmin": "streetname","c_desi":"type","c_liaison":"article",
+                                        "l_voie":"name","l_courtmin":"streetname_short","voie":"streetname_prep"})
+    # assign random rowid to Openparis data because they dont have them (seeded to get the same result every run)
+    Openparis = Openparis.assign(rowid = np.random.default_rng(seed).integers(7000, 200000, size=len(Openparis)))
+    Openparis = Openparis.assign(matching = [[]] * len(Openparis))
+    Merged = pd.concat([Unique, Openparis])
+
+    # check if streets with same name are at same location
+    MergedProcessed = duplicate_final(Merged, "streetname_prep")
+    MergedProcessed = preprocess(MergedProcessed, "name")
+    FinalDuplicates = MergedProcessed[MergedProcessed.duplicated(subset=['streetname_prep'], keep=False)]\
+        .sort_values("streetname_prep").convert_dtypes()
+    FinalUnique = MergedProcessed[~MergedProcessed.duplicated(subset=['streetname_prep'], keep=False)]\
+        .sort_values("streetname_prep").convert_dtypes()
+    write_dataset(FinalUnique, outputs["final_unique"])
+    write_dataset(FinalDuplicates.drop(columns=["buffer"]), outputs["final_duplicate"])
+
+    # group streets based on their short name
+    grouped_streets = FinalUnique.groupby("name_prep", as_index=False).agg({"streetname": ", ".join,
+            "geometry": list, "year": list, "rowid": list, "name": "first", "buffer":list})
+    unique_short_streets = grouped_streets[grouped_streets['buffer'].str.len() == 1].copy()
+    # (rowid stays a list, like the rowids of the merged overlapping streets)
+    unique_short_streets[["year", "geometry", "buffer"]] = \
+        unique_short_streets[["year", "geometry", "buffer"]].apply(lambda x: x.str[0])
+    multiple_short_streets = grouped_streets[grouped_streets['buffer'].str.len() > 1].copy()
+
+    # merge streets with the same short streetname if they all overlap
+    multiple_short_streets["all_overlap"] = multiple_short_streets["buffer"].apply(check_overlap)
+    overlap = multiple_short_streets[multiple_short_streets["all_overlap"]==True].copy()
+    overlap["geometry"] = overlap["geometry"].apply(lambda row: gpd.GeoSeries(row).unary_union)
+    overlap["buffer"] = overlap["buffer"].apply(lambda row: gpd.GeoSeries(row).unary_union)
+    # one list with the years of all merged streets, like the single streets
+    overlap["year"] = overlap["year"].apply(lambda years: [year for street_years in years for year in street_years])
+    overlap = overlap.drop(columns="all_overlap")
+    unique_short_streets = pd.concat([unique_short_streets, overlap])
+    write_dataset(unique_short_streets, outputs["unique_short"])
+    # multiple_short_streets will be neglected further on
+    write_dataset(multiple_short_streets, outputs["not_unique_short"])
+
+
+def run_alignment(inputs, outputs, tagged=True, cache_dir="data/fuzzy_cache"):
+    # Alignment.ipynb: aligns the bottin streets with the street data, as one cascade of stages
+    bottins = read_bottins(inputs["bottins_prep"])
+    streets = read_dataset(inputs["streets"])
+    unique_short_s = read_dataset(inputs["unique_short"])
+    non_unique_short_s = read_dataset(inputs["not_unique_short"])
+
+    remove_spaces = StringNormalizer(NO_SPACES_SUBSTITUTION, regex=True)
+    streets["no_spaces_long"] = remove_spaces(streets["streetname_prep"])
+    unique_short_s["no_spaces_short"] = remove_spaces(unique_short_s["name_prep"])
+    non_unique_short_s["no_spaces_short"] = remove_spaces(non_unique_short_s["name_prep"])
+    streets_all_vars = list(set(streets["streetname_prep"]))
+    # the aligned entries only get the street id, geometry, names and years are written once per street
+    aligned_streets = add_street_ids([streets, unique_short_s])
+    long_keys = streets[["streetname_prep", "no_spaces_long", "street_id"]]
+    short_keys = unique_short_s[["name_prep", "no_spaces_short", "street_id"]]
+    non_unique_keys = non_unique_short_s[["name_prep", "no_spaces_short"]]
+
+    # keys of the stages, computed on the distinct (not aligned) values of "rue_processed"
+    def substituted(rues):
+        return substitute_col_by_dict(rues, WORD_SUBSTITUTION)
+
+    def no_spaces(rues):
+        return remove_spaces(substituted(rues))
+
+    def fuzzy(score_cutoff):
+        def fuzzy_key(rues):
+            rues = substituted(rues)
+            fuzzy_dicts = get_cached_fuzzy_dicts(streets_all_vars, rues.unique().tolist(), score_cutoffs=[85, 80],
+                                                cache_dir=cache_dir)
+            return rues.map(fuzzy_dicts[score_cutoff])
+        fuzzy_key.__name__ = f"fuzzy{score_cutoff}"
+        return fuzzy_key
+
+    # the streets aligned on non_unique_short_s get their own method names, they are not in the result
+    stages = [
+        ("rue_processed", long_keys, "streetname_prep", "perfect"),
+        ("rue_processed", short_keys, "name_prep", "perfect short"),
+        ("rue_processed", non_unique_keys, "name_prep", "perfect short not unique"),
+        (substituted, long_keys, "streetname_prep", "perfect"),
+        (substituted, short_keys, "name_prep", "perfect short"),
+        (substituted, non_unique_keys, "name_prep", "perfect short not unique"),
+        (no_spaces, long_keys, "no_spaces_long", "no spaces perfect"),
+        (no_spaces, short_keys, "no_spaces_short", "no spaces perfect short"),
+        (no_spaces, non_unique_keys, "no_spaces_short", "no spaces perfect short not unique"),
+        (fuzzy(85), long_keys, "streetname_prep", "fuzzy 85"),
+        (fuzzy(80), long_keys, "streetname_prep", "fuzzy 80"),
+    ]
+    aligned, _, report = align_cascade(bottins, stages, vocabulary_column="rue_processed")
+
+    # aligned on FinalUnique first, then on unique_short_streets (like pd.concat([long_aligned, u_short_aligned]))
+    long_methods = ["perfect", "no spaces perfect", "fuzzy 85", "fuzzy 80"]
+    short_methods = ["perfect short", "no spaces perfect short"]
+    unique_aligned = pd.concat([aligned[aligned["align_method"].isin(long_methods)],
+                                aligned[aligned["align_method"].isin(short_methods)]])
+    unique_aligned["align_method"] = unique_aligned["align_method"].cat.remove_unused_categories()
+    # (entries aligned on non_unique_keys had no id, which made the column float)
+    unique_aligned["street_id"] = unique_aligned["street_id"].astype(streets["street_id"].dtype)
+    if tagged:
+        columns = ["row", "nom", "metier", "rue", "numero", "annee", "street_id", "align_method", "tags"]
+    else:
+        columns = ["page", "row", "nom", "metier", "rue", "numero", "annee", "street_id", "align_method"]
+    write_dataset(unique_aligned[columns], outputs["aligned"])
+    import geopandas as gpd
+    write_dataset(gpd.GeoDataFrame(aligned_streets, geometry="geometry", crs=streets.crs), outputs["streets"])
+    report["ratio_of_all"] = report["newly_aligned"] / len(bottins)
+    report.to_csv(outputs["report"], index=False)
+
+
+def load_rich_data(path):
+    # Analysis.ipynb: reads the aligned tagged data and prepares the columns used by the analysis
+    rich_data = read_dataset(path)
+    # make profession tags usable (from "['profession1', 'profession2']" to "profession1, profession2")
+    rich_data["tags"] = parse_tags(rich_data["tags"])
+    rich_data["annee_bin"] = get_annee_bin(rich_data["annee"])
+    return rich_data
+
+
+def run_cube(inputs, outputs, gridsize=4):
+    # counts of the aligned data per year, street, grid cell and tag, which the analysis stages are computed on
+    aligned_streets = read_dataset(inputs["streets"])
+    cube = build_cube(load_rich_data(inputs["aligned"]), aligned_streets, gridsize=gridsize)
+    write_dataset(cube, outputs["cube"])
+
+
+def run_basemap(inputs, outputs):
+    # downloads the basemap raster used by the maps (once)
+    get_basemap(outputs["basemap"])
+
+
+def run_ratio_over_time(inputs, outputs, min_frequency=50):
+    # Analysis.ipynb: development of the top 10 jobs and top 20 streets over the years
+    from matplotlib import pyplot as plt
+
+    cube = read_dataset(inputs["cube"])
+    aligned_streets = read_dataset(inputs["streets"])
+    freq_jobs = cube_top_names(cube, "tags", min_count=min_frequency)
+    top_names = {"jobs": (freq_jobs.index[:10].tolist(), "tags", "Development top 10 jobs in dataset"),
+                 "streets": (cube_top_names(cube, "streetname", n=20, streets=aligned_streets).index.tolist(),
+                            "streetname", "Development of most frequent streets in dataset")}
+    for role, (names, col_name, title) in top_names.items():
+        ratio_table = cube_ratio_over_time(cube, names, col_name, streets=aligned_streets)
+        ratio_table.to_csv(outputs[f"{role}_table"])
+        plot_ratio_over_time(None, names, col_name, title=title, ratio_table=ratio_table)
+        plt.gcf().savefig(outputs[f"{role}_figure"], bbox_inches="tight")
+        plt.close("all")
+
+
+def run_profession_gifs(inputs, outputs):
+    # Analysis.ipynb: gifs with the distribution of profession groups over the years
+    cube = read_dataset(inputs["cube"])
+    aligned_streets = read_dataset(inputs["streets"])
+    for prof_name, professions in GIF_PROFESSIONS.items():
+        gif_for_professions(expand_cube(cube, tags=professions), professions, prof_name, geo_col="geometry",
+                            basemap=inputs["basemap"], figures_dir=os.path.dirname(outputs[prof_name]),
+                            streets=aligned_streets)
+
+
+def run_change_over_years(inputs, outputs, gridsize=4):
+    # Analysis.ipynb: change of the professional mix per year (bin) in all of Paris (grid 0) and per grid cell
+    cube = read_dataset(inputs["cube"])
+    changes = []
+    for yearcolumn in ["annee", "annee_bin"]:
+        for grid in range(0, gridsize**2+1):
+            change, years = cube_change_over_years(cube, yearcolumn=yearcolumn, grid=None if grid == 0 else grid)
+            changes.append(pd.DataFrame({"yearcolumn": yearcolumn, "grid": grid, "year": list(years),
+                                        "change": change}))
+    pd.concat(changes).to_csv(outputs["changes"], index=False)
+
+
+def get_stages(data_dir="data", figures_dir="figures", tagged=True):
+    '''
+    Returns the stages of the pipeline (the analysis stages only for the tagged dataset).
+
+    Parameters
+    ---------------
+    :data_dir: folder with the input data and the intermediary results
+    :figures_dir: folder the figures are written to
+    :tagged: if True, use the bottin data with profession tags (paris_jobs_with_tags_richelieu_project.csv),
+            else strict_addressing.csv
+
+    Returns
+    ---------------
+    list of Stage
+    '''
+    data = lambda name: os.path.join(data_dir, name)
+    figure = lambda name: os.path.join(figures_dir, name)
+    suffix = "_tagged" if tagged else ""
+    bottins_csv = "paris_jobs_with_tags_richelieu_project.csv" if tagged else "strict_addressing.csv"
+    streets = {"streets": data("FinalUnique.parquet"), "unique_short": data("unique_short_streets.parquet"),
+               "not_unique_short": data("not_unique_short_streets.parquet")}
+
+    stages = [
+        Stage("preprocessing", run_preprocessing,
+              inputs={"bottins": data(bottins_csv), "voies": data("opendata_voie_paris.csv")},
+              outputs={"bottins_prep": data(f"bottins{suffix}_prep")},
+              code=["preprocessing.py"], params={"tagged": tagged}),
+        Stage("street_processing", run_street_processing,
+              inputs={"openparis": data("voie.zip"), "vasserot": data("vasserot.zip")},
+              outputs={"final_unique": streets["streets"], "final_duplicate": data("FinalDuplicate.parquet"),
+                       "unique_short": streets["unique_short"], "not_unique_short": streets["not_unique_short"]},
+              code=["preprocessing.py", "paris_methods.py", "storage.py"]),
+        Stage("alignment", run_alignment,
+              inputs={"bottins_prep": data(f"bottins{suffix}_prep"), **streets},
+              outputs={"aligned": data(f"unique_aligned{suffix}.parquet"),
+                       "streets": data(f"aligned_streets{suffix}.parquet"),
+                       "report": data(f"alignment_report{suffix}.csv")},
+              code=["alignment.py", "preprocessing.py", "storage.py"],
+              params={"tagged": tagged, "cache_dir": data("fuzzy_cache")}),
+    ]
+    if not tagged:
+        return stages
+
+    aligned_streets = data("aligned_streets_tagged.parquet")
+    cube = {"cube": data("analysis_cube.parquet"), "streets": aligned_streets}
+    gridsize = 4
+    stages += [
+        Stage("cube", run_cube, inputs={"aligned": data("unique_aligned_tagged.parquet"), "streets": aligned_streets},
+              outputs={"cube": cube["cube"]},
+              code=["cube.py", "analysis.py", "paris_methods.py", "alignment.py", "storage.py"],
+              params={"gridsize": gridsize}),
+        Stage("basemap", run_basemap, inputs={}, outputs={"basemap": figure("basemap.tif")}),
+        Stage("ratio_over_time", run_ratio_over_time, inputs=cube,
+              outputs={"jobs_table": data("ratio_top_jobs.csv"), "jobs_figure": figure("ratio_top_jobs.png"),
+                       "streets_table": data("ratio_top_streets.csv"),
+                       "streets_figure": figure("ratio_top_streets.png")},
+              code=["cube.py", "analysis.py", "storage.py"]),
+        Stage("profession_gifs", run_profession_gifs, inputs={**cube, "basemap": figure("basemap.tif")},
+              outputs={prof_name: figure(f"{prof_name}.gif") for prof_name in GIF_PROFESSIONS},
+              code=["cube.py", "analysis.py", "storage.py"]),
+        Stage("change_over_years", run_change_over_years, inputs={"cube": cube["cube"]},
+              outputs={"changes": data("change_over_years.csv")},
+              code=["cube.py", "paris_methods.py", "storage.py"], params={"gridsize": gridsize}),
+    ]
+    return stages
+
+
+def get_dependencies(stages):
+    '''
+    Returns the dependencies between the stages: a stage depends on the stages writing its inputs.
+    Raises a ValueError if two stages write the same file or if the stages contain a cycle.
+
+    Returns
+    ---------------
+    dictionary {stage name: set of names of the stages it depends on}, ordered topologically
+    '''
+    producers = {}
+    for stage in stages:
+        for path in stage.outputs.values():
+            if path in producers:
+                raise ValueError(f"{path} is written by the stages {producers[path]} and {stage.name}")
+            producers[path] = stage.name
+    dependencies = {stage.name: {producers[path] for path in stage.inputs.values() if path in producers}
+                    for stage in stages}
+
+    ordered = {}
+    while len(ordered) < len(dependencies):
+        ready = [name for name, deps in dependencies.items() if name not in ordered and deps.issubset(ordered)]
+        if not ready:
+            raise ValueError(f"cycle between the stages {sorted(set(dependencies) - set(ordered))}")
+        for name in ready:
+            ordered[name] = dependencies[name]
+    return ordered
+
+
+def _file_hash(path, file_cache):
+    # sha256 of a file, reused from file_cache as long as size and modification time do not change
+    stat = os.stat(path)
+    cached = file_cache.get(path)
+    if cached and cached["size"] == stat.st_size and cached["mtime_ns"] == stat.st_mtime_ns:
+        return cached["sha256"]
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            sha.update(block)
+    file_cache[path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": sha.hexdigest()}
+    return sha.hexdigest()
+
+
+def path_hash(path, file_cache):
+    '''
+    Returns the content hash of a file, or of a folder (e.g. a partitioned parquet dataset: hash of the
+    subfolders and contents of its files, independent of the file names), None if the path does not exist.
+    '''
+    if os.path.isfile(path):
+        return _file_hash(path, file_cache)
+    if not os.path.isdir(path):
+        return None
+    entries = []
+    for folder, _, files in os.walk(path):
+        relative = os.path.relpath(folder, path)
+        entries += [(relative, _file_hash(os.path.join(folder, file), file_cache)) for file in files]
+    return hashlib.sha256(json.dumps(sorted(entries)).encode("utf-8")).hexdigest()
+
+
+def stage_fingerprint(stage, file_cache):
+    '''
+    Returns the fingerprint of a stage: hash of its inputs, code (stage function and python files) and
+    parameters. Raises a FileNotFoundError if an input does not exist.
+    '''
+    content = {"inputs": {}, "code": {}, "function": inspect.getsource(stage.function),
+               "params": json.dumps(stage.params, sort_keys=True, default=str)}
+    for role, path in stage.inputs.items():
+        content["inputs"][role] = path_hash(path, file_cache)
+        if content["inputs"][role] is None:
+            raise FileNotFoundError(f"input {path} of stage {stage.name} does not exist")
+    for path in stage.code:
+        content["code"][path] = path_hash(path, file_cache)
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def load_state(path):
+    # state of the last runs: {"files": hash cache, "stages": {name: {"fingerprint": ..., ...}}}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"files": {}, "stages": {}}
+
+
+def save_state(state, path):
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+def is_up_to_date(stage, state):
+    # True if the stage ran successfully with the same fingerprint and its outputs still exist
+    try:
+        fingerprint = stage_fingerprint(stage, state["files"])
+    except FileNotFoundError:
+        return False
+    last_run = state["stages"].get(stage.name, {})
+    return last_run.get("fingerprint") == fingerprint and \
+        all(os.path.exists(path) for path in stage.outputs.values())
+
+
+def _execute(stage):
+    # runs a stage (in a worker process), returns its wall time
+    for path in stage.outputs.values():
+        parent = os.path.dirname(path)
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+    start = time.perf_counter()
+    stage.function(stage.inputs, stage.outputs, **stage.params)
+    return time.perf_counter() - start
+
+
+def _run_inline(stage):
+    # runs a stage in this process and returns a finished future (used with jobs=1)
+    future = Future()
+    try:
+        future.set_result(_execute(stage))
+    except Exception as error:
+        future.set_exception(error)
+    return future
+
+
+def run_pipeline(stages, selected=None, force=False, jobs=None, state_path="data/.pipeline_state.json", dry_run=False):
+    '''
+    Runs the stages in the order of their dependencies. A stage is skipped if it is up to date (same
+    inputs, code and parameters as in its last successful run and all outputs exist); stages whose
+    dependencies are finished are run in parallel processes.
+
+    Parameters
+    ---------------
+    :stages: list of Stage (see get_stages)
+    :selected: if not None, names of the stages to run, together with the stages they depend on
+    :force: if True, the selected stages (all if selected is None) are run even if they are up to date
+    :jobs: maximal number of stages running at the same time (1: run in this process), default: number of cpus
+    :state_path: path of the json file with the fingerprints of the last runs
+    :dry_run: if True, only print which stages would run
+
+    Returns
+    ---------------
+    dictionary {stage name: "done", "skipped", "failed", "blocked" (a dependency failed) or "pending" (dry run)}
+    '''
+    dependencies = get_dependencies(stages)
+    by_name = {stage.name: stage for stage in stages}
+    wanted = set(dependencies) if selected is None else set()
+    for name in selected or []:
+        if name not in by_name:
+            raise ValueError(f"unknown stage {name}, stages: {list(by_name)}")
+        stack = [name]
+        while stack:
+            current = stack.pop()
+            if current not in wanted:
+                wanted.add(current)
+                stack += list(dependencies[current])
+    forced = set(wanted if selected is None else selected) if force else set()
+    order = [name for name in dependencies if name in wanted]
+
+    state = load_state(state_path)
+
+    status = {}
+    if dry_run:
+        for name in order:
+            changed = any(status[dep] == "pending" for dep in dependencies[name])
+            status[name] = "pending" if name in forced or changed or not is_up_to_date(by_name[name], state) \
+                else "skipped"
+            print(f"{name:<20} {'would run' if status[name] == 'pending' else 'up to date'}")
+        return status
+
+    executor = ProcessPoolExecutor(jobs) if jobs != 1 else None
+    running = {}
+    try:
+        while len(status) < len(order):
+            # start all stages whose dependencies are finished
+            for name in order:
+                if name in status or name in running.values():
+                    continue
+                dep_status = [status.get(dep) for dep in dependencies[name]]
+                if any(s in ("failed", "blocked") for s in dep_status):
+                    status[name] = "blocked"
+                    print(f"[{name}] not run, a stage it depends on failed", flush=True)
+                    continue
+                if not all(s in ("done", "skipped") for s in dep_status):
+                    continue
+                stage = by_name[name]
+                if name not in forced and is_up_to_date(stage, state):
+                    status[name] = "skipped"
+                    print(f"[{name}] up to date, skipped", flush=True)
+                    continue
+                print(f"[{name}] started", flush=True)
+                if executor is None:
+                    running[_run_inline(stage)] = name
+                else:
+                    running[executor.submit(_execute, stage)] = name
+
+            if not running:
+                continue
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                stage = by_name[name]
+                try:
+                    wall_time = future.result()
+                except Exception:
+                    status[name] = "failed"
+                    print(f"[{name}] failed:\n{traceback.format_exc()}", flush=True)
+                    continue
+                status[name] = "done"
+                state["stages"][name] = {"fingerprint": stage_fingerprint(stage, state["files"]),
+                                        "outputs": {role: path_hash(path, state["files"])
+                                                    for role, path in stage.outputs.items()},
+                                        "wall_time": wall_time, "finished": time.time()}
+                save_state(state, state_path)
+                print(f"[{name}] done in {wall_time:.1f}s", flush=True)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    return status
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Runs the pipeline of the notebooks headless")
+    parser.add_argument("--stages", nargs="+", help="stages to run (with the stages they depend on)")
+    parser.add_argument("--force", action="store_true", help="run the selected stages even if up to date")
+    parser.add_argument("--jobs", type=int, default=None, help="number of stages running in parallel")
+    parser.add_argument("--untagged", action="store_true",
+                        help="use strict_addressing.csv instead of the data with profession tags")
+    parser.add_argument("--data-dir", default="data")
+    parser.add_argument("--figures-dir", default="figures")
+    parser.add_argument("--dry-run", action="store_true", help="only show which stages would run")
+    parser.add_argument("--list", action="store_true", help="list the stages with their inputs and outputs")
+    args = parser.parse_args(argv)
+
+    stages = get_stages(args.data_dir, args.figures_dir, tagged=not args.untagged)
+    if args.list:
+        dependencies = get_dependencies(stages)
+        for stage in stages:
+            print(f"{stage.name} (after: {', '.join(sorted(dependencies[stage.name])) or '-'})\n"
+                  f"    inputs:  {', '.join(stage.inputs.values()) or '-'}\n"
+                  f"    outputs: {', '.join(stage.outputs.values())}")
+        return 0
+    status = run_pipeline(stages, selected=args.stages, force=args.force, jobs=args.jobs, dry_run=args.dry_run,
+                          state_path=os.path.join(args.data_dir, STATE_FILE))
+    return 1 if any(s in ("failed", "blocked") for s in status.values()) else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,3 +1,76 @@
+import os
+import shutil
+import re
+import warnings
+import numpy as np
+import pandas as pd
+from instrumentation import instrument
+
+
+class StringNormalizer:
+    '''
+    Applies an ordered dictionary of substitutions (and optionally lowercasing) to a column of strings.
+    All patterns are compiled into one alternation regex which finds the strings that do not need any
+    substitution in a single pass, and the substitutions are only computed once per distinct value of the
+    column, then broadcast back to all rows.
+    The result is the same as with the former implementations:
+        regex=False: like substitute_col_by_dict, the substitutions are applied one after the other and each
+                    one is checked on the already substituted string
+        regex=True: like pandas' Series.replace(substitutions, regex=True), a substitution is applied if its
+                    pattern matches the original string, in the order of the dictionary
+
+    Parameters
+    ---------------
+    :substitutions: dictionary of the form {"incorrect/abbreviated word(s)" or regex pattern: "correct word(s)"}
+    :regex: if True, keys of substitutions are regex patterns, else plain strings
+    :lowercase: if True, strings are converted to lowercase before the substitutions
+    '''
+    def __init__(self, substitutions, regex=False, lowercase=False):
+        self.substitutions = list(substitutions.items())
+        self.regex = regex
+        self.lowercase = lowercase
+        if regex:
+            self.patterns = [(re.compile(pattern), value) for pattern, value in self.substitutions]
+            alternation = "|".join(f"(?:{pattern})" for pattern, _ in self.substitutions)
+        else:
+            alternation = "|".join(re.escape(incorrect) for incorrect, _ in self.substitutions)
+        self.any_pattern = re.compile(alternation) if self.substitutions else None
+
+    def normalize(self, value):
+        '''
+        normalizes one string (non-string values are returned unchanged, or as NaN if lowercase is True
+        like pandas' str.lower)
+        '''
+        if not isinstance(value, str):
+            return np.nan if self.lowercase else value
+        if self.lowercase:
+            value = value.lower()
+        # no pattern in the string -> nothing to substitute
+        if self.any_pattern is None or self.any_pattern.search(value) is None:
+            return value
+        if self.regex:
+            matching = [(pattern, new) for pattern, new in self.patterns if pattern.search(value)]
+            for pattern, new in matching:
+                value = pattern.sub(new, value)
+        else:
+            for incorrect, correct in self.substitutions:
+                if incorrect in value:
+                    value = value.replace(incorrect, correct)
+        return value
+
+    def __call__(self, column):
+        '''
+        normalizes a pandas Series of strings, returns a new Series with the same index
+        '''
+        codes, uniques = pd.factorize(column)
+        normalized = np.array([self.normalize(value) for value in uniques] + [None], dtype=object)
+        # missing values (code -1) are kept (or become NaN if lowercase, like pandas' str.lower)
+        missing = np.nan if self.lowercase else column.values
+        values = np.where(codes >= 0, normalized[codes], missing)
+        return pd.Series(values, index=column.index, name=column.name, dtype=object)
+
+
+@instrument
 def preprocess(df, column, new_colname=None, map_dict = {"é": "e", "è": "e", "ê":"e", "à":"a", 
                 "â":"a", "ô":"o", "î":"i", "û":"u", "ç":"c", "\-":" ", "\_":" ", "' ":"'", "  ":" "}):
     '''
@@ -19,8 +92,7 @@ def preprocess(df, column, new_colname=None, map_dict = {"é": "e", "è": "e", "
     data = df.copy()
     if not new_colname:
         new_colname = f"{column}_prep"
-    data[new_colname] = data[column].str.lower()
-    data[new_colname] = data[new_colname].replace(map_dict, regex=True)
+    data[new_colname] = StringNormalizer(map_dict, regex=True, lowercase=True)(data[column])
     return data
 
 def get_prefix(row, court, long):
@@ -63,6 +135,7 @@ def substitute_row_by_dict(row, word_dict):
     return row
 
 
+@instrument
 def substitute_col_by_dict(column, word_dict):
     '''
     finds and substitutes words in a column, using a dictionary
@@ -76,5 +149,307 @@ def substitute_col_by_dict(column, word_dict):
     ----------------------
     pandas Series which contains substitutions
     '''
-    return column.apply(substitute_row_by_dict, args=(word_dict,))
+    return StringNormalizer(word_dict)(column)
+
+
+def get_prefix_dict(voies_raw):
+    '''
+    Creates a dictionary of abbreviated street prefixes and their long version (e.g. {"boul.": "boulevard"})
+    from the Paris Opendata street dataset, completed by prefixes found by hand in the bottin data.
+
+    Parameters
+    ---------------
+    :voies_raw: pandas dataframe of the Paris Opendata streets ("data/opendata_voie_paris.csv"), with the
+                columns "L_VOIE", "L_COURTMIN" and "L_LONGMIN"
+
+    Returns
+    ---------------
+    dictionary of the form {abbreviated prefix: long prefix}
+    '''
+    #keep only columns that might be useful further on
+    voies = voies_raw.copy()[["N_SQ_VO", "L_VOIE", "L_COURTMIN", "L_LONGMIN", "Geometry"]]
+    voies.rename(columns = {'N_SQ_VO':'id2022'}, inplace = True)
+
+    #three different names for the streetnames
+    #example: L_VOIE: Malmaisons; L_COURTMIN: R. des Malmaisons; L_LONGMIN: Rue des Malmaisons
+    voies = preprocess(voies, "L_VOIE", new_colname="street_short")
+    voies = preprocess(voies, "L_COURTMIN", new_colname="street_abbr")
+    voies = preprocess(voies, "L_LONGMIN", new_colname="street_long")
+
+    # get prefixes, both abbreviated and long versions
+    voies["prefix_court"] = voies.apply(get_prefix, args=("street_short", "street_abbr"), axis=1)
+    voies["prefix_long"] = voies.apply(get_prefix, args=("street_short", "street_long"), axis=1)
+    # candidate dictionary of all the prefixes
+    prefix_candidates = dict(zip(voies["prefix_court"], voies["prefix_long"]))
+    # only get prefixes with . in it (otherwise would risk to get part of a name, not type of street)
+    prefix_dict = {key.split(" ")[0]:value.split(" ")[0] for key,value in prefix_candidates.items() if "." in key}
+
+    # add prefixes by hand (after look into data)
+    prefix_dict.update(MANUAL_PREFIXES)
+    return prefix_dict
+
+
+# prefixes added by hand to the prefix dictionary (after look into data)
+MANUAL_PREFIXES = {
+    "boul.": "boulevard",
+    "boulev.": "boulevard",
+    "boulv.": "boulevard",
+    "q.": "quai",
+    "aven.": "avenue",
+    "faub.": "faubourg",
+    "fau.": "faubourg",
+    "st.": "saint",
+    "impas.": "impasse",
+    "l'aub.": "l'auberge",
+    "laub": "l'auberge",
+    "st": "saint",
+    "ste": "sainte",
+    "sts": "saints",
+    "nve": "neuve",
+}
+
+
+# substitutions of abbreviations and OCR errors found by looking into the bottin data
+MANUAL_SUBSTITUTION = {
+    "alle. magne": "allemagne",
+    "ams. terdam": "amsterdam",
+    "av.": "avenue ",
+    "av.de": "avenue de ",
+    "ay.": "avenue",
+    "b. beaumarchais": "boulevard beaumarchais",
+    "b. bonne nouv.": "boulevard bonne nouvelle",
+    "b. bonne nouvelle": "boulevard bonne nouvelle",
+    "b. bonne. nouvelle": "boulevard bonne nouvelle",
+    "b. du temple": "boulevard du temple",
+    "b. poissonniere": "boulevard poissonniere",
+    "boul. ": "boulevard ",
+    "boul.": "boulevard ",
+    "boul.": "boulevard ",
+    "boul.de ": "boulevard de ",
+    "bouley. ": "boulevard",
+    "bouly.": "boulevard",
+    "bourb. villeneuve": "rue bourbon villeneuve",
+    "bourbon villen.": "rue bourbon villeneuve",
+    "bretonn.": "bretonnerie",
+    "carref. ": "carrefour ",
+    "ch. d'antin": "rue de la chaussee d'antin",
+    "chauss.": "chaussee ",
+    "chaussee d'antin": "rue de la chaussee d'antin",
+    "chaussee.": "chaussee",
+    "che. min": "chemin",
+    "cherche midi": "rue du cherche midi",
+    "cherche. midi": "rue du cherche midi",
+    "dame de": "damede ",
+    "dame.": "dame",
+    "denazareth": "de nazareth",
+    "dutemple": "du temple",
+    "echi. quier": "rue de l'echiquier",
+    "ecole de med.": "rue de l'ecole de medecine",
+    "eglise.": "eglise",
+    "f. du temple": "faubourg du temple",
+    "f. montmartre": "faubourg montmartre",
+    "f. poissoniere": "faubourg poissoniere",
+    "f. poissonniere": "faubourg poissonniere",
+    "f. saint ": "faubourg saint",
+    "faab. " : "faubourg",
+    "fanb. ": "faubourg",
+    "faub ": "faubourg",
+    "faub.. ": "faubourg",
+    "faub..": "faubourg ",
+    "faub..du": "faubourg du ",
+    "faub.": "faubourg ",
+    "faub.": "faubourg ",
+    "faub.du ": "faubourg du ",
+    "faub.montmartre": "faubourg montmartre",
+    "faub.poissonniere": "faubourg poissonniere",
+    "faub.st.": "faubourg saint",
+    "faub.st": "faubourg saint",
+    "faub).": "faubourg",
+    "faubourg du. temple": "rue du faubourg du temple",
+    "faubourg saint an. toine": "rue du faubourg saint antoine",
+    "faubourg saint ant.": "rue du faubourg saint antoine",
+    "faubourg. ": "faubourg",
+    "faubourg..": "faubourg",
+    "faubourg.": "faubourg",
+    "faubourg.du": "faubourg du",
+    "faubourgdu.": "faubourg du ",
+    "fauh. ": "faubourg",
+    "fauh.. ": "faubourg ",
+    "fauh.": "faubourg ",
+    "faul.": "faubourg ",
+    "faul).": "faubourg",
+    "fb. ": "faubourg",
+    "fd. poissonniere": "faubourg poissoniere",
+    "germain l'aux.": "germain l\'auxerrois",
+    "grande.": "grande",
+    "haub. ": "faubourg",
+    "hauss. mann": "haussmann",
+    "houl. ": "boulevard ",
+    "impass. ": "impasse",
+    "j j. rousseau": "jean jaques rousseau",
+    "j. j rousseau": "jean jaques rousseau",
+    "j. j.   rousseau": "jean jaques rousseau",
+    "j. j.  rousseau": "jean jaques rousseau",
+    "j. j. pousseau": "jean jaques rousseau",
+    "j. j. r": "jean jaques r",
+    "j. j. rousseau": "jean jaques rousseau",
+    "j. j.. rousseau": "jean jaques rousseau",
+    "j. j.rousseau": "jean jaques rousseau",
+    "j.j. rousseau": "jean jaques rousseau",
+    "lafayette": "la fayette",
+    "laub. ": "faubourg ",
+    "le. compte": "le compte",
+    "m. le prince": "rue monsieur le prince",
+    "ma. genta": "magenta",
+    "mar| tin": "martin",
+    "meri. court": "mericourt",
+    "mons. le prince": "rue monsieur le prince",
+    "mont. martre": "montmartre",
+    "montagne sainte gen.": "rue de la montagne sainte genevieve",
+    "montm.": "montmartre",
+    "montmar. tre": "montmartre",
+    "montmart.": "montmartre",
+    "n. d ": "notre dame",
+    "n. d.":"notre dame",
+    "n. da": "notre da",
+    "n. de nazareth": "notre dame de nazareth",
+    "n.d.": "notre dame",
+    "naza. reth": "nazareth",
+    "neuve. des petits champs": "rue neuve des petits champs",
+    "notre d. de": "notre dame de",
+    "notre damede naza. reth": "rue notre dame de nazareth",
+    "pass.du": "passage du",
+    "pe. tits": "petits",
+    "pet. champs": "petits champs",
+    "pet. ecuries":"petites ecuries",
+    "petites.": "petites ",
+    "petitesecuries": "petites ecuries",
+    "petits.": "petits",
+    "petitschamps": "petits champs",
+    "pois. sonniere": "poissonniere",
+    "poiss.": "poissonniere",
+    "poissonn.": "poissonniere",
+    "r.de": "rue de",
+    "r.des": "rue des",
+    "r.du ": "rue du ",
+    "r.st": "rue saint",
+    "rambu. teau": "rambouteau",
+    "riche. lieu": "richelieu",
+    "rue de vaugi. rard": "rue de vaugirard",
+    "saint ant.": "saint antoine",
+    "saint g. ": "saint germain",
+    "saint g.": "saint germain",
+    "saint germ.": "saint germain",
+    "saint hon.": "saint honore",
+    "saintgerm.": "saint germain",
+    "saints. peres": "rue des saints peres",
+    "se. basaintopol": "sebastopol",
+    "sebas. topol": "sebastopol",
+    "st.honore": "saint honore",
+    "stdenis": "saint denis",
+    "stgermain": "saint germain",
+    "sthonore": "saint honore",
+    "stmartin": "saint martin",
+    "stmichel": "saint michel",
+    "stras. bourg": "strassbourg",
+    "taub. ": "faubourg",
+    "tem. ple": "temple",
+    "vaugi. rard": "vaugirard",
+    "vi. vienne": "vivienne",
+    "vil. lette": "villette",
+    "vol. taire": "voltaire",
+    "n.  d. de": "notre dame de",
+    "b. poissonniere": "boulevard poissonniere",
+    "ri. voli": "rue de rivoli",
+    "croix des petits ch.": "rue croix des petits champs",
+    "males. herbes": "malesherbes",
+    "poisson. niere": "poissonniere",
+    "rous. seau": "rousseau",
+    "monsieur le. prince": "monsieur le prince",
+}
+
+
+
+@instrument
+def ingest_bottins(csv_path, out_dir, street_column="rue", rename=None, substitutions=(), chunksize=500000,
+                   categorical=("rue", "metier", "tags"), year_column="annee", overwrite=False, **read_csv_kwargs):
+    '''
+    Reads the bottin csv file in chunks, preprocesses the streets of every chunk (see preprocess and 
+    substitute_col_by_dict) and writes the result as a parquet dataset partitioned by year 
+    (one folder {year_column}={year} per year), with categorical text columns and an integer year column.
+    This way, the whole csv never has to be in memory and later steps can load only the columns and
+    years they need (see read_bottins).
+
+    Parameters
+    ---------------
+    :csv_path: path of the bottin csv file (e.g. "data/paris_jobs_with_tags_richelieu_project.csv")
+    :out_dir: folder the parquet dataset is written to (e.g. "data/bottins_prep")
+    :street_column: name of the street column (after renaming), the preprocessed streets are saved in
+                column "rue_processed"
+    :rename: if not None, dictionary to rename the columns of the csv file, e.g. {"Rue": "rue", "Nom": "nom"}
+    :substitutions: list of dictionaries of the form {"incorrect/abbreviated word(s)":"correct word(s)"},
+                applied one after the other on the preprocessed streets, 
+                e.g. [prefix_dict, manual_substitution, {"  ": " "}]
+    :chunksize: number of rows read and processed at once
+    :categorical: names of the columns which are stored as categories (if they exist)
+    :year_column: name of the year column the dataset is partitioned on
+    :overwrite: if True, an existing dataset in out_dir is deleted, else a FileExistsError is raised
+    :read_csv_kwargs: additional arguments for pandas.read_csv
+
+    Returns
+    ---------------
+    number of rows written (rows with a missing or non-numeric year are dropped with a warning)
+    '''
+    if os.path.exists(out_dir):
+        if not overwrite:
+            raise FileExistsError(f"{out_dir} already exists, use overwrite=True to replace it")
+        shutil.rmtree(out_dir)
+    normalizers = [StringNormalizer(word_dict) for word_dict in substitutions]
+
+    n_rows = 0
+    for chunk in pd.read_csv(csv_path, chunksize=chunksize, **read_csv_kwargs):
+        if rename:
+            chunk = chunk.rename(columns=rename)
+        chunk[street_column] = chunk[street_column].fillna("")
+        chunk = preprocess(chunk, street_column, "rue_processed")
+        for normalizer in normalizers:
+            chunk["rue_processed"] = normalizer(chunk["rue_processed"])
+
+        # rows without a valid year can not be partitioned, they are dropped
+        years = pd.to_numeric(chunk[year_column], errors="coerce")
+        invalid = years.isna()
+        if invalid.any():
+            warnings.warn(f"{int(invalid.sum())} rows without a valid {year_column} are dropped")
+            chunk, years = chunk[~invalid], years[~invalid]
+        chunk[year_column] = years.astype(np.int16)
+        for column in categorical:
+            if column in chunk.columns:
+                chunk[column] = chunk[column].astype("category")
+        chunk.to_parquet(out_dir, partition_cols=[year_column], compression="zstd", index=False)
+        n_rows += len(chunk)
+    return n_rows
+
 
+@instrument
+def read_bottins(path, columns=None, years=None, year_column="annee"):
+    '''
+    Reads (part of) the bottin dataset written by ingest_bottins.
+
+    Parameters
+    ---------------
+    :path: folder of the parquet dataset
+    :columns: if not None, list of the columns to read
+    :years: if not None, list of the years to read (only the folders of these years are opened)
+    :year_column: name of the year column the dataset is partitioned on
+
+    Returns
+    ---------------
+    pandas dataframe with the selected columns and years
+    '''
+    filters = [(year_column, "in", list(years))] if years is not None else None
+    if columns is not None and year_column not in columns:
+        columns = list(columns) + [year_column]
+    df = pd.read_parquet(path, columns=columns, filters=filters)
+    # partition values are read as categories
+    df[year_column] = df[year_column].astype(np.int16)
+    return df
@@ -0,0 +1,211 @@
+import json
+import sys
+import numpy as np
+import pandas as pd
+import shapely
+from shapely.geometry.base import BaseGeometry
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+from pyarrow.fs import LocalFileSystem
+from instrumentation import instrument
+
+
+# schema metadata key listing the geometry columns (stored as WKB) and their kind
+GEOMETRY_METADATA_KEY = b"paris_geometry"
+
+
+def _is_feather(path):
+    # feather/arrow files are written and read as arrow ipc files, everything else as parquet
+    return str(path).endswith((".feather", ".arrow"))
+
+
+def _geometry_kind(column):
+    # returns "geometry" for a column of geometries, "geometry_list" for a column of lists of geometries,
+    # None otherwise (all non-missing values have to be of the same kind)
+    if column.dtype.name == "geometry":
+        return "geometry"
+    if column.dtype != object:
+        return None
+    values = column.dropna().to_numpy(dtype=object)
+    if len(values) == 0:
+        return None
+    if shapely.is_geometry(values).all():
+        return "geometry"
+    if all(isinstance(value, (list, tuple, np.ndarray)) for value in values):
+        flat = [geometry for value in values for geometry in value]
+        if flat and all(isinstance(geometry, BaseGeometry) for geometry in flat):
+            return "geometry_list"
+    return None
+
+
+def _table_from_pandas(data, kinds):
+    # converts the dataframe to an arrow table; object columns arrow cannot convert (e.g. single values
+    # mixed with lists) raise a TypeError naming them, they have to be normalised before writing
+    try:
+        return pa.Table.from_pandas(data)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        pass
+    invalid = []
+    for column in data.columns:
+        if column in kinds or data[column].dtype != object:
+            continue
+        try:
+            pa.array(data[column], from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            invalid.append(column)
+    raise TypeError(f"columns {invalid} can not be stored, their values have to be of one type "
+                    "(e.g. only lists, not single values mixed with lists)")
+
+
+def _encode_geometry_list(values):
+    # converts a column of lists of geometries to lists of WKB, with one vectorized call
+    lengths = [len(value) if isinstance(value, (list, tuple, np.ndarray)) else 0 for value in values]
+    flat = [geometry for value, length in zip(values, lengths) if length for geometry in value]
+    wkb = shapely.to_wkb(np.array(flat, dtype=object)).tolist()
+    ends = np.cumsum(lengths)
+    return [wkb[end-length:end] if isinstance(value, (list, tuple, np.ndarray)) else None
+            for value, length, end in zip(values, lengths, ends)]
+
+
+def _decode_geometry_list(values):
+    # inverse of _encode_geometry_list
+    lengths = [len(value) if value is not None else 0 for value in values]
+    flat = [wkb for value, length in zip(values, lengths) if length for wkb in value]
+    geometries = shapely.from_wkb(np.array(flat, dtype=object)).tolist()
+    ends = np.cumsum(lengths)
+    return [geometries[end-length:end] if value is not None else None
+            for value, length, end in zip(values, lengths, ends)]
+
+
+@instrument
+def write_dataset(df, path, partition_cols=None, compression="zstd"):
+    '''
+    Writes a (geo)pandas dataframe (e.g. street data or aligned bottin data) to a columnar file, instead of
+    pickling it. Geometry columns (shapely objects, also lists of them like in not_unique_short_streets)
+    are stored as WKB. Single geometry columns are described in GeoParquet metadata, so the file can be
+    opened by other GeoParquet readers as well. Columns mixing single values and lists raise a TypeError.
+
+    Parameters
+    ---------------
+    :df: (geo)pandas dataframe
+    :path: path of the file, ".feather"/".arrow": arrow ipc file (best for memory mapped reads),
+            else: parquet file or folder (if partition_cols is given)
+    :partition_cols: if not None, list of columns the parquet dataset is partitioned on (e.g. ["annee"])
+    :compression: compression of the file ("zstd", "lz4", "uncompressed", ...)
+    '''
+    data = pd.DataFrame(df).copy()
+    default_crs = getattr(df, "crs", None)
+    # (a GeoDataFrame can only exist if geopandas has been imported, which is not done here for plain data)
+    geopandas = sys.modules.get("geopandas")
+    primary = df.geometry.name if geopandas is not None and isinstance(df, geopandas.GeoDataFrame) else None
+
+    kinds, geo_columns = {}, {}
+    for column in data.columns:
+        kind = _geometry_kind(data[column])
+        if kind is None:
+            continue
+        kinds[column] = kind
+        if kind == "geometry":
+            from pyproj import CRS
+            crs = getattr(data[column].values, "crs", None) or default_crs
+            data[column] = shapely.to_wkb(np.asarray(data[column], dtype=object))
+            geo_columns[column] = {"encoding": "WKB", "geometry_types": [],
+                                    "crs": CRS(crs).to_json_dict() if crs is not None else None}
+        else:
+            data[column] = _encode_geometry_list(data[column].tolist())
+
+    table = _table_from_pandas(data, kinds)
+    metadata = dict(table.schema.metadata or {})
+    metadata[GEOMETRY_METADATA_KEY] = json.dumps(kinds).encode("utf-8")
+    if geo_columns:
+        if primary not in geo_columns:
+            primary = "geometry" if "geometry" in geo_columns else next(iter(geo_columns))
+        metadata[b"geo"] = json.dumps({"version": "1.0.0", "primary_column": primary,
+                                        "columns": geo_columns}).encode("utf-8")
+    table = table.replace_schema_metadata(metadata)
+
+    if _is_feather(path):
+        if partition_cols:
+            raise ValueError("partitioning is only supported for parquet datasets")
+        feather.write_feather(table, path, compression=compression)
+    elif partition_cols:
+        pq.write_to_dataset(table, path, partition_cols=partition_cols, compression=compression,
+                            existing_data_behavior="delete_matching")
+    else:
+        pq.write_table(table, path, compression=compression)
+
+
+@instrument
+def read_dataset(path, columns=None, years=None, year_column="annee", memory_map=True, decode_geometry=True):
+    '''
+    Reads a file written by write_dataset, only loading the selected columns and rows of the selected years.
+
+    Parameters
+    ---------------
+    :path: path of the file or partitioned folder
+    :columns: if not None, list of columns to read
+    :years: if not None, list of years to read; the rows are selected on year_column, which can be an integer
+            column (e.g. "annee" of the bottin data) or a column with lists of years (e.g. "year" of the
+            street data, a row is kept if one of its years is selected)
+    :year_column: name of the column the years are selected on
+    :memory_map: if True, the file is memory mapped instead of read into memory
+    :decode_geometry: if True, WKB is converted back to shapely geometries and a GeoDataFrame is returned
+                (if the primary geometry column is read), else the WKB bytes are kept
+
+    Returns
+    ---------------
+    (geo)pandas dataframe
+    '''
+    file_format = "ipc" if _is_feather(path) else "parquet"
+    dataset = ds.dataset(path, format=file_format, partitioning="hive",
+                        filesystem=LocalFileSystem(use_mmap=memory_map))
+    metadata = dataset.schema.metadata or {}
+    kinds = json.loads(metadata.get(GEOMETRY_METADATA_KEY, b"{}"))
+
+    filter_expression, list_years = None, False
+    if years is not None:
+        if pa.types.is_list(dataset.schema.field(year_column).type):
+            list_years = True
+        else:
+            filter_expression = ds.field(year_column).isin(list(years))
+    read_columns = columns
+    if list_years and columns is not None and year_column not in columns:
+        read_columns = list(columns) + [year_column]
+    table = dataset.to_table(columns=read_columns, filter=filter_expression)
+
+    if list_years:
+        # keep rows with at least one selected year in their list of years (also lists of lists of years)
+        flat = table.column(year_column).combine_chunks()
+        parents = np.arange(len(flat))
+        while pa.types.is_list(flat.type):
+            parents = parents[np.asarray(pc.list_parent_indices(flat))]
+            flat = pc.list_flatten(flat)
+        selected = np.unique(parents[np.asarray(pc.is_in(flat, value_set=pa.array(list(years))))])
+        table = table.take(pa.array(selected, type=pa.int64()))
+        if read_columns is not columns:
+            table = table.drop([year_column])
+
+    df = table.replace_schema_metadata(metadata).to_pandas()
+    if not decode_geometry:
+        return df
+
+    for column, kind in kinds.items():
+        if column not in df.columns:
+            continue
+        if kind == "geometry":
+            df[column] = shapely.from_wkb(np.asarray(df[column], dtype=object))
+        elif kind == "geometry_list":
+            df[column] = _decode_geometry_list(df[column].tolist())
+        else:
+            raise ValueError(f"column {column} of {path} is stored as {kind}, write the file again")
+    geo = json.loads(metadata.get(b"geo", b"{}"))
+    primary = geo.get("primary_column")
+    if primary in df.columns:
+        import geopandas as gpd
+        from pyproj import CRS
+        crs = geo["columns"][primary].get("crs")
+        df = gpd.GeoDataFrame(df, geometry=primary, crs=CRS.from_json_dict(crs) if crs else None)
+    return df